@@ -0,0 +1,85 @@
+##############################################################################
+#
+# Copyright (c) 2008 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Compare the crypto backends.
+
+Besides the keys a backend generates itself, the keys generated by the
+other backends are unwrapped, since a storage directory holds the keys of
+the backend used when they were created.
+
+Usage: python benchmarks/backends.py [keys]
+"""
+import statistics
+import sys
+import tempfile
+import time
+
+from keas.kmi.backends import availableBackends
+from keas.kmi.facility import KeyManagementFacility
+
+
+def median(func, count):
+    times = []
+    for i in range(count):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000
+
+
+def facility(storage_dir, name):
+    kmf = KeyManagementFacility(storage_dir)
+    kmf.cryptoBackend = name
+    kmf.durability = 'none'
+    return kmf
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    count = int(argv[0]) if argv else 10
+    data = b'x' * 1024
+    names = availableBackends()
+    print('%-14s %12s %12s %14s' % (
+        'backend', 'generate', 'unwrap', 'encrypt 1KB'))
+    generated = {}
+    for name in names:
+        kmf = facility(tempfile.mkdtemp(), name)
+        keys = [kmf.generate() for i in range(count)]
+        generated[name] = (kmf.storage_dir, keys)
+        # Do not measure the cache.
+        kmf.timeout = 0
+        unwrap = iter(keys)
+        generate = median(kmf.generate, count)
+        unwrap = median(lambda: kmf.getEncryptionKey(next(unwrap)), count)
+        kmf.timeout = 3600
+        encrypt = median(lambda: kmf.encrypt(keys[0], data), count * 100)
+        print('%-14s %9.2f ms %9.2f ms %11.3f ms' % (
+            name, generate, unwrap, encrypt))
+    print()
+    print('Unwrapping the keys generated by each backend:')
+    print('%-14s' % 'generated by' + ''.join('%14s' % n for n in names))
+    for source in names:
+        storage_dir, keys = generated[source]
+        row = '%-14s' % source
+        for name in names:
+            kmf = facility(storage_dir, name)
+            kmf.timeout = 0
+            unwrap = iter(keys)
+            row += '%11.2f ms' % median(
+                lambda: kmf.getEncryptionKey(next(unwrap)), count)
+        print(row)
+
+
+if __name__ == '__main__':
+    main()
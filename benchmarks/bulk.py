@@ -0,0 +1,56 @@
+##############################################################################
+#
+# Copyright (c) 2008 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Compare the per message overhead of single and bulk encryption.
+
+Usage: python benchmarks/bulk.py [messages] [size]
+"""
+import os
+import sys
+import tempfile
+import time
+
+from keas.kmi.facility import KeyManagementFacility
+
+
+def measure(func, count):
+    start = time.perf_counter()
+    func()
+    return (time.perf_counter() - start) / count * 1e6
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    count = int(argv[0]) if argv else 10000
+    size = int(argv[1]) if len(argv) > 1 else 64
+    kmf = KeyManagementFacility(tempfile.mkdtemp())
+    key = kmf.generate()
+    messages = [os.urandom(size) for i in range(count)]
+    encrypted = kmf.encrypt_many(key, messages)
+
+    print('%-16s %12s %12s' % ('method', 'encrypt', 'decrypt'))
+    print('%-16s %9.1f us %9.1f us' % (
+        'single',
+        measure(lambda: [kmf.encrypt(key, m) for m in messages], count),
+        measure(lambda: [kmf.decrypt(key, m) for m in encrypted], count)))
+    for workers in (1, 4):
+        kmf.bulkWorkers = workers
+        print('%-16s %9.1f us %9.1f us' % (
+            'bulk (%d threads)' % workers,
+            measure(lambda: kmf.encrypt_many(key, messages), count),
+            measure(lambda: kmf.decrypt_many(key, encrypted), count)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+##############################################################################
+#
+# Copyright (c) 2008 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Compare the number of keys stored per second at each durability level.
+
+Only storing is measured; generating the key encrypting keys would dominate
+otherwise. Run it on the file system the keys are stored on in production.
+
+Usage: python benchmarks/durability.py [keys] [threads] [directory]
+"""
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from keas.kmi.durability import DURABILITY_LEVELS
+from keas.kmi.facility import KeyManagementFacility
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    count = int(argv[0]) if argv else 1000
+    threads = int(argv[1]) if len(argv) > 1 else 16
+    directory = argv[2] if len(argv) > 2 else None
+    # Stored keys have the size of an RSA encrypted encryption key.
+    keys = [os.urandom(256) for i in range(count)]
+    print('%-8s %12s' % ('level', 'keys/sec'))
+    for level in DURABILITY_LEVELS:
+        kmf = KeyManagementFacility(tempfile.mkdtemp(dir=directory))
+        kmf.durability = level
+
+        def store(i):
+            kmf['%032x' % i] = keys[i]
+
+        with ThreadPoolExecutor(threads) as executor:
+            start = time.perf_counter()
+            list(executor.map(store, range(count)))
+            elapsed = time.perf_counter() - start
+        kmf.close()
+        print('%-8s %12.0f' % (level, count / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+##############################################################################
+#
+# Copyright (c) 2008 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Compare key generation and unwrapping for the key encrypting key schemes.
+
+Usage: python benchmarks/keyschemes.py [keys]
+"""
+import statistics
+import sys
+import tempfile
+import time
+
+from keas.kmi.facility import KeyManagementFacility
+
+
+SCHEMES = [
+    ('rsa', None),
+    ('ecc', 'P-256'),
+    ('ecc', 'X25519'),
+]
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    count = int(argv[0]) if argv else 10
+    print('%-12s %12s %12s' % ('scheme', 'generate', 'unwrap'))
+    for scheme, curve in SCHEMES:
+        kmf = KeyManagementFacility(tempfile.mkdtemp())
+        kmf.keyScheme = scheme
+        if curve:
+            kmf.eccCurve = curve
+        # Do not measure the cache.
+        kmf.timeout = 0
+        generate, unwrap = [], []
+        for i in range(count):
+            start = time.perf_counter()
+            key = kmf.generate()
+            generate.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            kmf.getEncryptionKey(key)
+            unwrap.append(time.perf_counter() - start)
+        print('%-12s %9.2f ms %9.2f ms' % (
+            curve or scheme,
+            statistics.median(generate) * 1000,
+            statistics.median(unwrap) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+##############################################################################
+#
+# Copyright (c) 2008 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Measure the start-up time of the Key Management Server applications.
+
+Every run starts a fresh Python process which imports the WSGI module,
+creates the application and serves a single status request, i.e. the work
+a new server process has to do before it can answer requests.
+
+Usage: python benchmarks/startup.py [runs]
+"""
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+SCRIPT = """
+from webob import Request
+from keas.kmi import wsgi
+app = wsgi.%s({}, **{'storage-dir': %r})
+assert Request.blank('/').get_response(app).status_int == 200
+"""
+
+
+def measure(factory, storage_dir, runs):
+    timings = []
+    for i in range(runs):
+        start = time.perf_counter()
+        subprocess.check_call(
+            [sys.executable, '-c', SCRIPT % (factory, storage_dir)])
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    runs = int(argv[0]) if argv else 10
+    storage_dir = tempfile.mkdtemp()
+    # Python's own start-up time, for reference.
+    start = time.perf_counter()
+    for i in range(runs):
+        subprocess.check_call([sys.executable, '-c', 'pass'])
+    baseline = (time.perf_counter() - start) / runs
+    print('python interpreter:        %7.1f ms' % (baseline * 1000))
+    for factory in ('application_factory', 'lean_application_factory'):
+        timings = measure(factory, storage_dir, runs)
+        print('%-26s %7.1f ms (median of %d, min %.1f ms)' % (
+            factory + ':', statistics.median(timings) * 1000, runs,
+            min(timings) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -65,13 +65,22 @@ setup(
     namespace_packages=['keas'],
     python_requires='>=3.7',
     extras_require=dict(
+        openssl=[
+            'cryptography',
+        ],
         test=[
+            'cryptography',
+            'ZODB',
             'zope.testing',
             'zope.app.testing',
         ],
+        zodb=[
+            'ZODB',
+        ],
     ),
     install_requires=[
-        'pycryptodome',
+        # Crypto.Protocol.DH.key_agreement for elliptic curve keys
+        'pycryptodome >= 3.20.0',
         'pyramid',
         'pyramid_zcml',
         'setuptools',
@@ -83,8 +92,12 @@ setup(
     entry_points="""
     [console_scripts]
     testclient = keas.kmi.testclient:main
+    rotatekeys = keas.kmi.rotation:main
+    loadtest = keas.kmi.loadtest:main
 
     [paste.app_factory]
     main = keas.kmi.wsgi:application_factory
+    lean = keas.kmi.wsgi:lean_application_factory
+    proxy = keas.kmi.wsgi:proxy_application_factory
     """,
 )
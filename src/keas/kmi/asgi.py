@@ -0,0 +1,191 @@
+##############################################################################
+#
+# Copyright (c) 2008 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""ASGI variant of the REST API
+
+It lives in its own module, so the WSGI applications do not import asyncio
+and the process pool on start-up.
+"""
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import md5
+from urllib.parse import quote
+
+from webob import Request
+from webob import Response
+from webob import exc
+
+from keas.kmi.facility import COMPACT_REQUEST_TYPE
+from keas.kmi.rest import get_cached_key
+from keas.kmi.rest import get_changes
+from keas.kmi.rest import get_key
+from keas.kmi.rest import get_status
+from keas.kmi.rest import key_not_found
+
+
+# The facility used by the processes of the ASGI application's process pool.
+_worker_facility = None
+
+
+def _init_worker(factory, storage_dir, keyScheme, changelog, durability,
+                 cryptoBackend):
+    global _worker_facility
+    _worker_facility = factory(storage_dir)
+    _worker_facility.keyScheme = keyScheme
+    _worker_facility.durability = durability
+    _worker_facility.cryptoBackend = cryptoBackend
+    if changelog:
+        from keas.kmi.replication import ChangeLog
+        _worker_facility.changelog = ChangeLog(storage_dir)
+
+
+def _generate():
+    return _worker_facility.generate()
+
+
+def _get_encryption_key(key):
+    return _worker_facility.getEncryptionKey(key)
+
+
+def _asgi_request(scope, body):
+    """Create a webob request from an ASGI HTTP scope."""
+    headers = [(name.decode('latin-1'), value.decode('latin-1'))
+               for name, value in scope.get('headers', ())]
+    root_path = scope.get('root_path', '')
+    path = scope['path']
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    server = scope.get('server') or ('localhost', 80)
+    host = {name.lower(): value for name, value in headers}.get(
+        'host', '%s:%s' % tuple(server))
+    url = quote(path)
+    query_string = scope.get('query_string', b'').decode('latin-1')
+    if query_string:
+        url += '?' + query_string
+    return Request.blank(
+        url, method=scope['method'], body=body, headers=headers,
+        base_url='%s://%s%s' % (
+            scope.get('scheme', 'http'), host, quote(root_path)))
+
+
+def _render(request, response):
+    result = {}
+
+    def start_response(status, headerlist, exc_info=None):
+        result['status'] = int(status.split(' ', 1)[0])
+        result['headers'] = [
+            (name.lower().encode('latin-1'), value.encode('latin-1'))
+            for name, value in headerlist]
+
+    body = b''.join(response(request.environ, start_response))
+    return result['status'], result['headers'], body
+
+
+class ASGIApplication:
+    """ASGI variant of the REST API.
+
+    Requests for cached encryption keys are answered directly on the event
+    loop. Key generation and decryption of encryption keys happen in a pool
+    of processes, each with its own facility on the same storage directory,
+    so a single server process can handle many concurrent clients.
+    Concurrent requests for the same uncached key share a single decryption.
+    """
+
+    def __init__(self, context, executor=None, processes=None):
+        self.context = context
+        if executor is None:
+            executor = ProcessPoolExecutor(
+                processes, initializer=_init_worker,
+                initargs=(type(context), context.storage_dir,
+                          context.keyScheme, context.changelog is not None,
+                          context.durability, context.cryptoBackend))
+        self.executor = executor
+        self._pending = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+        request = _asgi_request(scope, body)
+        status, headers, body = _render(request, await self.handle(request))
+        await send({'type': 'http.response.start',
+                    'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def handle(self, request):
+        route = (request.method, request.path_info)
+        if route == ('GET', '/'):
+            # Counting the keys lists the storage directory.
+            return await self.runInThread(get_status, self.context, request)
+        if route == ('GET', '/changes'):
+            return await self.runInThread(get_changes, self.context, request)
+        if route == ('POST', '/new'):
+            return Response(
+                await self.run(_generate),
+                charset='utf-8',
+                headerlist=[('Content-Type', 'text/plain')])
+        if route == ('POST', '/key'):
+            key = request.body
+            if request.content_type == COMPACT_REQUEST_TYPE:
+                return get_cached_key(self.context, request)
+            if self.context.getCachedEncryptionKey(key) is None:
+                # Keys unknown to the workers are remembered here as well,
+                # so retrying clients do not keep the process pool busy.
+                hash_key = md5(key).hexdigest()
+                if self.context.unknownKeys.hit(hash_key):
+                    return key_not_found(self.context)
+                try:
+                    await self.fetch(key)
+                except KeyError:
+                    self.context.unknownKeys.add(hash_key)
+                    return key_not_found(self.context)
+            return get_key(self.context, request)
+        if request.path_info in ('/', '/changes', '/new', '/key'):
+            return exc.HTTPMethodNotAllowed()
+        return exc.HTTPNotFound()
+
+    async def run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    async def runInThread(self, func, *args):
+        """Run blocking work of this process off the event loop."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, func, *args)
+
+    async def fetch(self, key):
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = self._pending[key] = asyncio.ensure_future(
+                self.run(_get_encryption_key, key))
+            pending.add_done_callback(
+                lambda future: self._pending.pop(key, None))
+        encryptionKey = await asyncio.shield(pending)
+        self.context.cacheEncryptionKey(key, encryptionKey)
+        return encryptionKey
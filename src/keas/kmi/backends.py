@@ -0,0 +1,206 @@
+##############################################################################
+#
+# Copyright (c) 2008 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Backends providing the cryptographic primitives
+
+The facilities use AES in CBC mode for the data, RSA with PKCS#1 v1.5
+padding for wrapping the encryption keys, and random bytes. Two backends
+provide them: PyCryptodome, which is always installed, and the OpenSSL
+based ``cryptography`` package, which generates RSA keys a lot faster.
+Both produce compatible data and keys. PyCryptodome is used unless
+configured otherwise, since it unwraps the keys of both backends faster
+(see ``benchmarks/backends.py``), and a storage directory mostly holds
+existing keys.
+
+The crypto modules are only imported when a backend is first used.
+"""
+import importlib
+import os
+import threading
+
+from keas.kmi import tracing
+
+
+class PyCryptodomeBackend:
+    """The primitives implemented by PyCryptodome."""
+
+    name = 'pycryptodome'
+
+    def __init__(self):
+        self.AES = importlib.import_module('Crypto.Cipher.AES')
+        self.PKCS1_v1_5 = importlib.import_module('Crypto.Cipher.PKCS1_v1_5')
+        self.RSA = importlib.import_module('Crypto.PublicKey.RSA')
+        self.Random = importlib.import_module('Crypto.Random')
+
+    def randomBytes(self, size):
+        return self.Random.get_random_bytes(size)
+
+    def cbcEncryptor(self, key, iv):
+        """Return a function encrypting consecutive chunks of data."""
+        return self.AES.new(key=key, mode=self.AES.MODE_CBC, IV=iv).encrypt
+
+    def cbcDecryptor(self, key, iv):
+        """Return a function decrypting consecutive chunks of data."""
+        return self.AES.new(key=key, mode=self.AES.MODE_CBC, IV=iv).decrypt
+
+    def rsaGenerate(self, bits, exponent, passphrase):
+        """Return a new private key as encrypted PEM and its public key."""
+        rsa = self.RSA.generate(bits, e=exponent)
+        return rsa.exportKey(passphrase=passphrase), rsa.publickey()
+
+    def rsaEncrypt(self, publicKey, data):
+        return self.PKCS1_v1_5.new(publicKey).encrypt(data)
+
+    def rsaDecrypt(self, privateKey, passphrase, data):
+        """Decrypt with the PEM encoded private key.
+
+        :raises ValueError: if the data cannot be decrypted.
+        """
+        with tracing.phase('importKey'):
+            rsa = self.RSA.importKey(privateKey, passphrase)
+        error = object()
+        with tracing.phase('decrypt'):
+            decrypted = self.PKCS1_v1_5.new(rsa).decrypt(data, error)
+        if decrypted is error:
+            raise ValueError('Error while decrypting key.')
+        return decrypted
+
+
+class CryptographyBackend:
+    """The primitives implemented by the ``cryptography`` package."""
+
+    name = 'cryptography'
+
+    def __init__(self):
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import padding
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        from cryptography.hazmat.primitives.ciphers import Cipher
+        from cryptography.hazmat.primitives.ciphers import algorithms
+        from cryptography.hazmat.primitives.ciphers import modes
+        self.serialization = serialization
+        self.padding = padding
+        self.rsa = rsa
+        self.Cipher = Cipher
+        self.algorithms = algorithms
+        self.modes = modes
+
+    def randomBytes(self, size):
+        return os.urandom(size)
+
+    def _cbc(self, key, iv):
+        return self.Cipher(self.algorithms.AES(key), self.modes.CBC(iv))
+
+    def cbcEncryptor(self, key, iv):
+        """Return a function encrypting consecutive chunks of data."""
+        encryptor = self._cbc(key, iv).encryptor()
+
+        def encrypt(data):
+            if len(data) % 16:
+                raise ValueError(
+                    'Data must be padded to 16 byte boundary in CBC mode')
+            return encryptor.update(data)
+        return encrypt
+
+    def cbcDecryptor(self, key, iv):
+        """Return a function decrypting consecutive chunks of data."""
+        decryptor = self._cbc(key, iv).decryptor()
+
+        def decrypt(data):
+            if len(data) % 16:
+                raise ValueError(
+                    'Data must be padded to 16 byte boundary in CBC mode')
+            return decryptor.update(data)
+        return decrypt
+
+    def rsaGenerate(self, bits, exponent, passphrase):
+        """Return a new private key as encrypted PEM and its public key."""
+        rsa = self.rsa.generate_private_key(exponent, bits)
+        privateKey = rsa.private_bytes(
+            self.serialization.Encoding.PEM,
+            self.serialization.PrivateFormat.PKCS8,
+            self.serialization.BestAvailableEncryption(passphrase.encode()))
+        return privateKey, rsa.public_key()
+
+    def rsaEncrypt(self, publicKey, data):
+        return publicKey.encrypt(data, self.padding.PKCS1v15())
+
+    def rsaDecrypt(self, privateKey, passphrase, data):
+        """Decrypt with the PEM encoded private key.
+
+        :raises ValueError: if the data cannot be decrypted.
+        """
+        # Unlike PyCryptodome, a passphrase for an unencrypted key is an error.
+        if b'ENCRYPTED' not in privateKey:
+            passphrase = None
+        try:
+            with tracing.phase('importKey'):
+                rsa = self.serialization.load_pem_private_key(
+                    privateKey, passphrase and passphrase.encode())
+            with tracing.phase('decrypt'):
+                return rsa.decrypt(data, self.padding.PKCS1v15())
+        except (ValueError, TypeError):
+            raise ValueError('Error while decrypting key.')
+
+
+BACKENDS = {
+    PyCryptodomeBackend.name: PyCryptodomeBackend,
+    CryptographyBackend.name: CryptographyBackend,
+}
+
+# The backends tried, in this order, when none is configured. Unwrapping
+# existing keys is what a server mostly does, so the backend doing that
+# fastest comes first.
+PREFERRED = (PyCryptodomeBackend.name, CryptographyBackend.name)
+
+_instances = {}
+_lock = threading.Lock()
+
+
+def getBackend(name=None):
+    """Return the backend called ``name``.
+
+    Without a name, or with ``auto``, the first available backend of
+    ``PREFERRED`` is returned.
+    """
+    with _lock:
+        if name in _instances:
+            return _instances[name]
+        if name in (None, 'auto'):
+            for preferred in PREFERRED:
+                try:
+                    backend = _instances.get(preferred)
+                    if backend is None:
+                        backend = BACKENDS[preferred]()
+                        _instances[preferred] = backend
+                except ImportError:
+                    continue
+                break
+        elif name in BACKENDS:
+            backend = BACKENDS[name]()
+        else:
+            raise ValueError('Unknown crypto backend: %r' % name)
+        _instances[name] = backend
+        return backend
+
+
+def availableBackends():
+    """Return the names of the backends that can be used."""
+    names = []
+    for name in BACKENDS:
+        try:
+            getBackend(name)
+        except ImportError:
+            continue
+        names.append(name)
+    return names
@@ -0,0 +1,70 @@
+##############################################################################
+#
+# Copyright (c) 2008 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Encrypted ZODB blobs
+
+This module needs the ZODB, which is installed with ``keas.kmi[zodb]``.
+"""
+import os
+
+import persistent
+import ZODB.blob
+from zope.component import getUtility
+
+from keas.kmi.interfaces import IEncryptionService
+from keas.kmi.interfaces import IKeyHolder
+from keas.kmi.streams import DecryptingReader
+from keas.kmi.streams import EncryptingWriter
+
+
+class EncryptedBlob(persistent.Persistent):
+    """A blob whose file is stored in encrypted form.
+
+    The data is encrypted while it is written and decrypted while it is
+    read, so large files never have to be held in memory. Only the modes
+    ``r``, ``w`` and ``c`` are supported.
+
+    ZODB does not allow subclassing ``Blob``, so the file is kept in a blob
+    of its own.
+    """
+
+    def __init__(self, data=None):
+        self.blob = ZODB.blob.Blob()
+        if data is not None:
+            with self.open('w') as file:
+                file.write(data)
+
+    def open(self, mode='r'):
+        if mode not in ('r', 'w', 'c'):
+            raise ValueError('Encrypted blobs only support the modes '
+                             "'r', 'w' and 'c', not %r" % mode)
+        key = getUtility(IKeyHolder).key
+        service = getUtility(IEncryptionService)
+        file = self.blob.open(mode)
+        if mode == 'w':
+            return EncryptingWriter(service, key, file)
+        return DecryptingReader(service, key, file)
+
+    def committed(self):
+        """Return the name of the committed, encrypted file."""
+        return self.blob.committed()
+
+    def consumeFile(self, filename):
+        """Encrypt the file into the blob and remove it."""
+        with open(filename, 'rb') as fsrc, self.open('w') as fdst:
+            while True:
+                chunk = fsrc.read(64 * 1024)
+                if not chunk:
+                    break
+                fdst.write(chunk)
+        os.remove(filename)
@@ -0,0 +1,133 @@
+##############################################################################
+#
+# Copyright (c) 2008 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Encrypted persistent cache of encryption keys
+"""
+import sqlite3
+import struct
+import threading
+import time
+from hashlib import sha256
+
+import Crypto.Cipher.AES
+import Crypto.Random
+
+
+# The time the key was fetched and the time to live the master asked for
+HEADER = struct.Struct('<dd')
+
+
+def fingerprint(key):
+    """Return the fingerprint of a key encrypting key."""
+    return sha256(key).hexdigest()
+
+
+class PersistentKeyCache:
+    """A sqlite file mapping key encrypting key fingerprints to encryption
+    keys.
+
+    sqlite locks the file, so the worker processes of a server can share a
+    single cache file. Entries are sealed with AES-GCM under a key derived
+    from the node key, so the file is useless without it. The fingerprint
+    is authenticated as well, preventing entries from being swapped between
+    keys.
+    """
+
+    def __init__(self, filename, nodeKey):
+        self.filename = filename
+        self._sealKey = sha256(nodeKey).digest()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            filename, timeout=30, isolation_level=None,
+            check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS entries'
+            ' (name TEXT PRIMARY KEY, data BLOB NOT NULL)')
+
+    def _delete(self, name):
+        self._db.execute('DELETE FROM entries WHERE name = ?', (name,))
+
+    def _seal(self, name, data):
+        nonce = Crypto.Random.get_random_bytes(12)
+        cipher = Crypto.Cipher.AES.new(
+            self._sealKey, Crypto.Cipher.AES.MODE_GCM, nonce=nonce)
+        cipher.update(name.encode())
+        encrypted, tag = cipher.encrypt_and_digest(data)
+        return nonce + tag + encrypted
+
+    def _unseal(self, name, data):
+        nonce, tag, encrypted = data[:12], data[12:28], data[28:]
+        cipher = Crypto.Cipher.AES.new(
+            self._sealKey, Crypto.Cipher.AES.MODE_GCM, nonce=nonce)
+        cipher.update(name.encode())
+        return cipher.decrypt_and_verify(encrypted, tag)
+
+    def get(self, key, timeout):
+        """Return a ``(time, encryptionKey, ttl)`` tuple or ``None``.
+
+        ``ttl`` is the time to live the master asked for when the key was
+        fetched, or ``None``. Entries older than ``timeout`` seconds or their
+        ``ttl``, or which cannot be unsealed with the node key, are removed
+        and treated as missing.
+        """
+        name = fingerprint(key)
+        with self._lock:
+            row = self._db.execute(
+                'SELECT data FROM entries WHERE name = ?', (name,)).fetchone()
+            if row is None:
+                return None
+            try:
+                data = self._unseal(name, row[0])
+            except ValueError:
+                self._delete(name)
+                return None
+            fetched, ttl = HEADER.unpack(data[:HEADER.size])
+            if fetched + min(ttl, timeout) <= time.time():
+                self._delete(name)
+                return None
+            if ttl == float('inf'):
+                ttl = None
+            return fetched, data[HEADER.size:], ttl
+
+    def set(self, key, encryptionKey, fetched=None, ttl=None):
+        if fetched is None:
+            fetched = time.time()
+        if ttl is None:
+            ttl = float('inf')
+        name = fingerprint(key)
+        data = self._seal(name, HEADER.pack(fetched, ttl) + encryptionKey)
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO entries (name, data) VALUES (?, ?)',
+                (name, data))
+
+    def invalidate(self, key):
+        with self._lock:
+            self._delete(fingerprint(key))
+
+    def clear(self):
+        with self._lock:
+            self._db.execute('DELETE FROM entries')
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute(
+                'SELECT count(*) FROM entries').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __repr__(self):
+        return '<{} {!r}>'.format(self.__class__.__name__, self.filename)
@@ -0,0 +1,366 @@
+##############################################################################
+#
+# Copyright (c) 2008 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Durable storage of the encrypted encryption keys
+
+Keys are always written to a temporary file first and renamed, so readers
+never see a partially written key. How much is done to survive a crash of
+the machine depends on the durability level:
+
+``none``
+  The operating system writes the keys to disk whenever it likes.
+
+``fsync``
+  Every key is synced to disk before it is handed out.
+
+``group``
+  New keys are appended to a journal, and concurrent writers share a single
+  sync of the journal. After a crash, the keys are restored from it.
+"""
+import base64
+import ctypes
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+
+logger = logging.getLogger('kmi')
+
+try:
+    _syncfs = ctypes.CDLL(None, use_errno=True).syncfs
+except (OSError, AttributeError, TypeError):  # pragma: no cover
+    _syncfs = None
+
+DURABILITY_LEVELS = ('none', 'fsync', 'group')
+
+
+def syncDirectory(path):
+    """Make renames and removals in the directory durable."""
+    if not hasattr(os, 'O_DIRECTORY'):  # pragma: no cover
+        return
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def syncFiles(directory, names):
+    """Sync the files ``names`` in ``directory`` to disk.
+
+    Where possible, the whole file system is synced at once, which is much
+    faster than syncing many files one by one.
+    """
+    if _syncfs is not None:
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            if _syncfs(fd) == 0:
+                return
+        finally:
+            os.close(fd)
+    elif hasattr(os, 'sync'):  # pragma: no cover
+        os.sync()
+        return
+    for name in names:  # pragma: no cover
+        try:
+            with open(os.path.join(directory, name), 'rb+') as file:
+                os.fsync(file.fileno())
+        except FileNotFoundError:
+            # The file was removed.
+            pass
+
+
+def writeFile(path, data, sync=False):
+    """Replace the file at ``path`` atomically.
+
+    With ``sync``, the data and the rename are on disk when returning.
+    """
+    directory = os.path.dirname(path)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+            if sync:
+                file.flush()
+                os.fsync(file.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    if sync:
+        syncDirectory(directory)
+
+
+def _tryLock(file):
+    if fcntl is None:  # pragma: no cover
+        return True
+    try:
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return False
+    return True
+
+
+class Journal:
+    """An append-only journal of the keys written by a facility.
+
+    Writers append their record and wait until it is synced. The first
+    writer to find no sync in progress syncs everything appended so far,
+    including the records of writers arriving while it waited for the disk.
+    If that sync fails, all writers of the batch get the error.
+
+    Every ``checkpointSize`` records, a background thread starts a new
+    journal file, syncs the key files recorded in the old one, and removes
+    it. Writers only wait for the switch to the new file, not for the disk.
+    The thread is started when the first checkpoint is due and stopped by
+    ``close()``.
+
+    The journal files are locked while in use, so ``recover()`` only
+    restores keys from journals whose facility is gone.
+    """
+
+    prefix = 'journal-'
+    suffix = '.log'
+    checkpointSize = 1000
+    # The number of failed batches remembered for the writers waiting on them
+    maxFailures = 100
+
+    def __init__(self, storage_dir):
+        self.storage_dir = storage_dir
+        self.path, self._file = self._open()
+        self._cond = threading.Condition()
+        self._buffer = []
+        self._names = set()
+        self._changelogs = set()
+        self._appended = 0
+        self._taken = 0
+        self._durable = 0
+        self._failures = []
+        self._flushing = False
+        self._closed = False
+        # The number of syncs, to tell how well writes were grouped.
+        self.syncs = 0
+        self.checkpoints = 0
+        self._checkpointWanted = threading.Event()
+        # Started with the first checkpoint
+        self._checkpointer = None
+
+    def _open(self):
+        # Journals are named by their creation time, so ``recover()``
+        # replays them in order.
+        path = os.path.join(self.storage_dir, '{}{:020d}-{}{}'.format(
+            self.prefix, time.time_ns(), uuid.uuid4().hex, self.suffix))
+        file = open(path, 'ab')
+        _tryLock(file)
+        return path, file
+
+    @staticmethod
+    def format(action, name, key=None):
+        line = '{} {}'.format(action, name)
+        if key is not None:
+            line += ' ' + base64.b64encode(key).decode('ascii')
+        return (line + '\n').encode('ascii')
+
+    def add(self, name, key, changelog=None):
+        """Record a new key.
+
+        A ``changelog`` the key was added to is synced together with the
+        journal.
+        """
+        self._commit(self.format('add', name, key), name, changelog)
+
+    def remove(self, name, changelog=None):
+        self._commit(self.format('del', name), name, changelog)
+
+    def _failure(self, number):
+        for first, last, error in self._failures:
+            if first < number <= last:
+                return error
+        return None
+
+    def _commit(self, line, name, changelog=None):
+        with self._cond:
+            self._buffer.append(line)
+            self._names.add(name)
+            if changelog is not None:
+                self._changelogs.add(changelog)
+            self._appended += 1
+            number = self._appended
+            while True:
+                error = self._failure(number)
+                if error is not None:
+                    raise error
+                if self._durable >= number:
+                    return
+                if not self._flushing:
+                    self._flushing = True
+                    break
+                self._cond.wait()
+        try:
+            self._flush()
+        finally:
+            with self._cond:
+                self._flushing = False
+                self._cond.notify_all()
+
+    def _flush(self):
+        with self._cond:
+            lines, self._buffer = self._buffer, []
+            changelogs, self._changelogs = self._changelogs, set()
+            first, number = self._taken, self._appended
+            self._taken = number
+        position = self._file.tell()
+        try:
+            self._file.write(b''.join(lines))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            for changelog in changelogs:
+                changelog.sync()
+        except Exception as error:
+            # Do not leave part of a record in front of the next batch.
+            try:
+                self._file.truncate(position)
+            except OSError:
+                pass
+            with self._cond:
+                self._failures.append((first, number, error))
+                del self._failures[:-self.maxFailures]
+            raise
+        self.syncs += 1
+        with self._cond:
+            self._durable = number
+            if len(self._names) >= self.checkpointSize and not self._closed:
+                if self._checkpointer is None:
+                    self._checkpointer = threading.Thread(
+                        target=self._checkpointLoop,
+                        name='kmi-journal-checkpoint', daemon=True)
+                    self._checkpointer.start()
+                self._checkpointWanted.set()
+
+    def _checkpointLoop(self):
+        while True:
+            self._checkpointWanted.wait()
+            self._checkpointWanted.clear()
+            if self._closed:
+                return
+            try:
+                self.checkpoint()
+            except Exception:
+                logger.exception('Checkpoint of %s failed', self.path)
+
+    def _switch(self, reopen):
+        # Take the place of the writer syncing the journal, so no records
+        # are written while the file changes.
+        with self._cond:
+            while self._flushing:
+                self._cond.wait()
+            self._flushing = True
+        try:
+            if self._buffer:
+                self._flush()
+            with self._cond:
+                names, self._names = self._names, set()
+            path, file = self.path, self._file
+            if reopen:
+                self.path, self._file = self._open()
+        finally:
+            with self._cond:
+                self._flushing = False
+                self._cond.notify_all()
+        return names, path, file
+
+    def _retire(self, names, path, file):
+        syncFiles(self.storage_dir, [name + '.dek' for name in names])
+        syncDirectory(self.storage_dir)
+        file.close()
+        os.remove(path)
+        self.checkpoints += 1
+
+    def checkpoint(self):
+        """Sync the journaled key files and start a new journal."""
+        self._retire(*self._switch(reopen=True))
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            checkpointer = self._checkpointer
+        if checkpointer is not None:
+            self._checkpointWanted.set()
+            checkpointer.join()
+        self._retire(*self._switch(reopen=False))
+
+
+def replay(storage_dir, data):
+    """Restore the keys recorded in the journal data.
+
+    Returns the number of restored keys.
+    """
+    state = {}
+    # A last line without a newline was cut off by the crash, and was never
+    # acknowledged to the writer.
+    for line in data.decode('ascii').split('\n')[:-1]:
+        action, name, *rest = line.split(' ')
+        if action == 'add':
+            state[name] = base64.b64decode(rest[0])
+        elif action == 'del':
+            state[name] = None
+    restored = 0
+    for name, key in state.items():
+        path = os.path.join(storage_dir, name + '.dek')
+        if key is None:
+            if os.path.exists(path):
+                os.remove(path)
+            continue
+        try:
+            with open(path, 'rb') as file:
+                if file.read() == key:
+                    continue
+        except FileNotFoundError:
+            pass
+        writeFile(path, key, sync=True)
+        restored += 1
+    syncDirectory(storage_dir)
+    return restored
+
+
+def recover(storage_dir):
+    """Restore keys from the journals left behind by crashed facilities.
+
+    Returns the number of restored keys.
+    """
+    restored = 0
+    for filename in sorted(os.listdir(storage_dir)):
+        if not (filename.startswith(Journal.prefix) and
+                filename.endswith(Journal.suffix)):
+            continue
+        path = os.path.join(storage_dir, filename)
+        with open(path, 'rb') as file:
+            if not _tryLock(file):
+                # Still in use by a running facility.
+                continue
+            count = replay(storage_dir, file.read())
+        os.remove(path)
+        if count:
+            logger.warning('Restored %d keys from %s', count, filename)
+        restored += count
+    return restored
@@ -0,0 +1,215 @@
+##############################################################################
+#
+# Copyright (c) 2008 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Latency-aware selection of key management server endpoints
+"""
+import collections
+import logging
+import socket
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+
+
+logger = logging.getLogger('kmi')
+
+
+class EndpointError(OSError):
+    """A server answered with an error status."""
+
+
+class Endpoint:
+    """A key management server and what we know about its health."""
+
+    def __init__(self, url):
+        self.url = url
+        # Exponentially weighted moving average of the latency in seconds.
+        self.latency = None
+        self.failures = 0
+        self.openUntil = None
+
+    @property
+    def available(self):
+        """False while the circuit breaker is open."""
+        return self.openUntil is None or self.openUntil <= time.time()
+
+    def __repr__(self):
+        if self.latency is None:
+            return '<Endpoint {!r}>'.format(self.url)
+        return '<Endpoint {!r} {:.1f}ms>'.format(
+            self.url, self.latency * 1000)
+
+
+class EndpointPool:
+    """Choose among several servers by observed latency and health.
+
+    Requests go to the fastest available endpoint first. If it fails, the
+    next one is tried. If it does not answer within the ``hedgePercentile``
+    of the observed latencies, a second, hedged request is sent to the next
+    endpoint and whichever answers first wins.
+
+    Requests which are not idempotent, like generating a key, are neither
+    hedged nor sent again after an arbitrary failure: the failed server may
+    have acted on them anyway. They only go to the next endpoint if they
+    never reached the server, as told by ``unsentErrors``.
+
+    After ``failureThreshold`` consecutive failures, the circuit breaker of
+    an endpoint opens: it is skipped for ``resetTimeout`` seconds, and
+    re-probed in a background thread in the meantime.
+    """
+
+    alpha = 0.3
+    hedgePercentile = 95
+    initialHedgeDelay = 1.0
+    minSamples = 20
+    failureThreshold = 3
+    resetTimeout = 10.0
+    probeInterval = 1.0
+    unsentErrors = (ConnectionRefusedError, socket.gaierror)
+
+    def __init__(self, urls, probe=None):
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.probe = probe
+        self.samples = collections.deque(maxlen=200)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._prober = None
+        self._closed = threading.Event()
+
+    def ordered(self):
+        """Return the endpoints in the order they should be tried."""
+        with self._lock:
+            available = [ep for ep in self.endpoints if ep.available]
+            if not available:
+                # Better to try a broken endpoint than to give up.
+                return sorted(self.endpoints, key=lambda ep: ep.openUntil)
+            # Endpoints without measurements come first, so they get some.
+            return sorted(
+                available,
+                key=lambda ep: -1 if ep.latency is None else ep.latency)
+
+    def hedgeDelay(self):
+        with self._lock:
+            if len(self.samples) < self.minSamples:
+                return self.initialHedgeDelay
+            samples = sorted(self.samples)
+        index = min(len(samples) - 1,
+                    int(len(samples) * self.hedgePercentile / 100))
+        return samples[index]
+
+    def recordSuccess(self, endpoint, latency):
+        with self._lock:
+            if endpoint.latency is None:
+                endpoint.latency = latency
+            else:
+                endpoint.latency += self.alpha * (latency - endpoint.latency)
+            endpoint.failures = 0
+            endpoint.openUntil = None
+            self.samples.append(latency)
+
+    def recordFailure(self, endpoint):
+        with self._lock:
+            endpoint.failures += 1
+            if endpoint.failures < self.failureThreshold:
+                return
+            endpoint.openUntil = time.time() + self.resetTimeout
+        logger.warning('Endpoint %s failed %d times, skipping it',
+                       endpoint.url, endpoint.failures)
+        self._startProbing()
+
+    def _attempt(self, endpoint, func):
+        start = time.perf_counter()
+        try:
+            result = func(endpoint.url)
+        except Exception:
+            self.recordFailure(endpoint)
+            raise
+        self.recordSuccess(endpoint, time.perf_counter() - start)
+        return result
+
+    def call(self, func, idempotent=True):
+        """Call ``func(url)`` for the best endpoint and return the result.
+
+        ``func`` raises an exception if the endpoint failed. If all
+        endpoints fail, the last exception is raised.
+        """
+        candidates = self.ordered()
+        if not idempotent:
+            for endpoint in candidates[:-1]:
+                try:
+                    return self._attempt(endpoint, func)
+                except self.unsentErrors:
+                    continue
+            return self._attempt(candidates[-1], func)
+        if len(candidates) == 1:
+            return self._attempt(candidates[0], func)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                2 * len(self.endpoints), thread_name_prefix='kmi-request')
+        delay = self.hedgeDelay()
+        pending = set()
+        hedged = False
+        error = None
+        while candidates or pending:
+            if candidates and (not pending or not hedged):
+                if pending:
+                    hedged = True
+                pending.add(self._executor.submit(
+                    self._attempt, candidates.pop(0), func))
+            done, pending = wait(
+                pending, timeout=delay if candidates and not hedged else None,
+                return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+                # A failed request does not count as a hedge.
+                hedged = False
+        raise error
+
+    def _startProbing(self):
+        with self._lock:
+            if self.probe is None or self._prober is not None:
+                return
+            self._prober = threading.Thread(
+                target=self._probeLoop, name='kmi-probe', daemon=True)
+        self._prober.start()
+
+    def _probeLoop(self):
+        while not self._closed.wait(self.probeInterval):
+            with self._lock:
+                broken = [ep for ep in self.endpoints
+                          if ep.openUntil is not None]
+                if not broken:
+                    self._prober = None
+                    return
+            for endpoint in broken:
+                start = time.perf_counter()
+                try:
+                    self.probe(endpoint.url)
+                except Exception:
+                    continue
+                logger.info('Endpoint %s is back', endpoint.url)
+                self.recordSuccess(endpoint, time.perf_counter() - start)
+        self._prober = None
+
+    def close(self):
+        """Stop all threads of the pool."""
+        self._closed.set()
+        if self._prober is not None:
+            self._prober.join()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
@@ -15,33 +15,179 @@
 """
 
 import binascii
+import collections
+import hmac
+import importlib
 import logging
 import os
+import re
 import struct
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import md5
+from hashlib import sha256
 from http.client import HTTPConnection
 from http.client import HTTPSConnection
 from urllib.parse import urlparse
 
-import Crypto.Cipher
-import Crypto.Cipher.AES
-import Crypto.Cipher.PKCS1_v1_5
-import Crypto.PublicKey.RSA
-from Crypto.Random import random
 from zope.interface import implementer
 
+from keas.kmi import durability as _durability
 from keas.kmi import interfaces
+from keas.kmi import tracing
+from keas.kmi.backends import getBackend
+from keas.kmi.endpoints import EndpointError
+from keas.kmi.endpoints import EndpointPool
 
 
 logger = logging.getLogger('kmi')
 
+# Content types of the compact key protocol: the client sends the hash of
+# the key encrypting key and a proof of possession (see ``keyProof()``)
+# instead of the key itself, and receives the encryption key as binary data
+# with caching headers.
+COMPACT_REQUEST_TYPE = 'application/x-kmi-fingerprint'
+COMPACT_RESPONSE_TYPE = 'application/octet-stream'
+
+
+# Prefix of encryption keys wrapped with an elliptic curve key encrypting key
+ECIES_MAGIC = b'KMI-ECIES-1:'
+
+
+def _eciesKDF(secret):
+    return KDF.HKDF(secret, 32, b'', SHA256, context=ECIES_MAGIC)
+
+
+def keyProof(key):
+    """Return a proof of possession of the key encrypting key.
+
+    Clients send it together with the key's hash instead of the key itself
+    to fetch encryption keys which the master has already decrypted.
+    """
+    return sha256(b'keas.kmi proof:' + key).hexdigest()
+
+
+class _LazyModule:
+    """A module that is only imported when one of its attributes is used.
+
+    Importing the crypto modules is a noticeable part of the start-up time
+    of the server, and not every process needs all of them.
+    """
+
+    def __init__(self, name):
+        self.__name = name
+
+    def __getattr__(self, name):
+        return getattr(importlib.import_module(self.__name), name)
+
+    def __repr__(self):
+        return '<lazy module {!r}>'.format(self.__name)
+
+
+AES = _LazyModule('Crypto.Cipher.AES')
+DH = _LazyModule('Crypto.Protocol.DH')
+ECC = _LazyModule('Crypto.PublicKey.ECC')
+KDF = _LazyModule('Crypto.Protocol.KDF')
+SHA256 = _LazyModule('Crypto.Hash.SHA256')
+
+
+class NegativeCache:
+    """Remember for a short time which keys are unknown.
+
+    Clients retrying with a wrong key encrypting key would otherwise cause a
+    lookup on disk or a request to the server every time. At most ``size``
+    keys are remembered, the least recently asked for are dropped first.
+
+    ``hits`` and ``misses`` count the lookups answered from the cache and
+    the keys found to be unknown. ``counts`` tells how often each of the
+    remembered keys was asked for, so misbehaving clients can be spotted.
+    """
+
+    # Log a warning every time a key was asked for that many times.
+    warnEvery = 100
+
+    def __init__(self, timeout=5, size=10000):
+        self.timeout = timeout
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.counts = collections.Counter()
+        self._expires = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, name):
+        expires = self._expires.get(name)
+        return expires is not None and expires > time.time()
+
+    def __len__(self):
+        return len(self._expires)
+
+    def _count(self, name):
+        self.counts[name] += 1
+        if self.counts[name] % self.warnEvery == 0:
+            logger.warning('Unknown key requested %d times (hash): %s',
+                           self.counts[name], name)
+
+    def hit(self, name):
+        """Return whether ``name`` is known to be unknown, and count it."""
+        with self._lock:
+            if name not in self:
+                return False
+            self._expires.move_to_end(name)
+            self.hits += 1
+            self._count(name)
+        return True
+
+    def add(self, name, timeout=None):
+        """Remember that ``name`` is unknown.
+
+        The ``timeout`` may shorten the default one, for example when the
+        server asks for it.
+        """
+        if timeout is None or timeout > self.timeout:
+            timeout = self.timeout
+        with self._lock:
+            self.misses += 1
+            self._count(name)
+            self._expires[name] = time.time() + timeout
+            self._expires.move_to_end(name)
+            while len(self._expires) > self.size:
+                oldest, expires = self._expires.popitem(last=False)
+                del self.counts[oldest]
+
+    def discard(self, name):
+        """Forget about ``name``, for example because it was just added."""
+        with self._lock:
+            self._expires.pop(name, None)
+            self.counts.pop(name, None)
+
+    def clear(self):
+        with self._lock:
+            self._expires.clear()
+            self.counts.clear()
+
+
+# Thread pools for bulk operations by number of workers, shared by all
+# facilities, so bulk calls do not pay for starting threads.
+_bulkExecutors = {}
+_bulkExecutorsLock = threading.Lock()
+
+
+def _getBulkExecutor(workers):
+    with _bulkExecutorsLock:
+        if workers not in _bulkExecutors:
+            _bulkExecutors[workers] = ThreadPoolExecutor(
+                workers, thread_name_prefix='kmi-bulk')
+        return _bulkExecutors[workers]
+
 
 @implementer(interfaces.IEncryptionService)
 class EncryptionService:
 
-    CipherFactory = Crypto.Cipher.AES
-    CipherMode = Crypto.Cipher.AES.MODE_CBC
+    # The name of the backend providing AES, RSA and random bytes, see
+    # ``keas.kmi.backends``. By default, the fastest available one is used.
+    cryptoBackend = None
 
     # Note: Decryption fails if you use an empty initialization vector; but it
     # only fails when you restart the Python process.  The length of the
@@ -50,6 +196,13 @@ class EncryptionService:
     # prints if you execute it on the command line
     initializationVector = b'0123456789ABCDEF'
 
+    # Batches of at least ``bulkThreshold`` messages are split among
+    # ``bulkWorkers`` threads by ``encrypt_many()`` and ``decrypt_many()``.
+    # ``benchmarks/bulk.py`` showed no gain from more threads for small or
+    # large messages, so measure before raising it.
+    bulkThreshold = 512
+    bulkWorkers = 1
+
     def _pkcs7Encode(self, text, k=16):
         n = k - (len(text) % k)
         return text + binascii.unhexlify(n * ("%02x" % n))
@@ -70,18 +223,52 @@ class EncryptionService:
         key += md5(key + data).digest()
         return key
 
+    @property
+    def backend(self):
+        return getBackend(self.cryptoBackend)
+
+    def _getDerivedKey(self, key):
+        # The AES key actually used by the cipher; resolving it once allows
+        # callers to process many messages without repeated key lookups.
+        return self._bytesToKey(self.getEncryptionKey(key))
+
     def encrypt(self, key, data):
         """See interfaces.IEncryptionService"""
         # 1. Extract the encryption key
-        encryptionKey = self._bytesToKey(self.getEncryptionKey(key))
-        # 2. Create a cipher object
-        cipher = self.CipherFactory.new(
-            key=encryptionKey, mode=self.CipherMode,
-            IV=self.initializationVector)
-        # 3. Apply padding.
+        encryptionKey = self._getDerivedKey(key)
+        # 2. Encrypt the data
+        return self._encrypt(encryptionKey, data)
+
+    def _encrypt(self, encryptionKey, data):
+        # 1. Create a cipher object
+        encrypt = self.backend.cbcEncryptor(
+            encryptionKey, self.initializationVector)
+        # 2. Apply padding.
         data = self._pkcs7Encode(data)
-        # 4. Encrypt the data and return it.
-        return cipher.encrypt(data)
+        # 3. Encrypt the data and return it.
+        return encrypt(data)
+
+    def encrypt_many(self, key, messages):
+        """See interfaces.IEncryptionService"""
+        # The encryption key is only looked up and derived once.
+        encryptionKey = self._getDerivedKey(key)
+        return self._many(self._encrypt, encryptionKey, messages)
+
+    def _many(self, func, encryptionKey, messages):
+        messages = list(messages)
+        if len(messages) < self.bulkThreshold or self.bulkWorkers < 2:
+            return [func(encryptionKey, data) for data in messages]
+
+        def process(chunk):
+            return [func(encryptionKey, data) for data in chunk]
+
+        size = -(-len(messages) // self.bulkWorkers)
+        chunks = [messages[i:i + size]
+                  for i in range(0, len(messages), size)]
+        executor = _getBulkExecutor(self.bulkWorkers)
+        return [result
+                for results in executor.map(process, chunks)
+                for result in results]
 
     def encrypt_file(self, key, fsrc, fdst, chunksize=24 * 1024):
         """ Encrypts a file with the given key.
@@ -96,28 +283,28 @@ class EncryptionService:
                           chunksize must be divisible by 16.
         """
         # 1. Extract the encryption key
-        encryptionKey = self._bytesToKey(self.getEncryptionKey(key))
+        encryptionKey = self._getDerivedKey(key)
+        # 2. Encrypt the file
+        self._encryptFile(encryptionKey, fsrc, fdst, chunksize)
 
-        # 2. Create a random initialization vector
-        iv = bytes((random.randint(0, 0xFF)) for i in range(16))
+    def _encryptFile(self, encryptionKey, fsrc, fdst, chunksize=24 * 1024):
+        # 1. Create a random initialization vector
+        iv = self.backend.randomBytes(16)
 
-        # 3. Create a cipher object
-        cipher = self.CipherFactory.new(
-            key=encryptionKey, mode=self.CipherMode,
-            IV=iv
-        )
+        # 2. Create a cipher object
+        encrypt = self.backend.cbcEncryptor(encryptionKey, iv)
 
-        # 4. Get the current position so we can seek later back to it
+        # 3. Get the current position so we can seek later back to it
         #    so we can write the filesize.
         fdst_startpos = fdst.tell()
 
-        # 5. Write a spacer for the later filesize.
+        # 4. Write a spacer for the later filesize.
         fdst.write(struct.pack('<Q', 0))
 
-        # 6. Write the initialization vector.
+        # 5. Write the initialization vector.
         fdst.write(iv)
 
-        # 7. Read plain and write the encrypted file.
+        # 6. Read plain and write the encrypted file.
         filesize = 0
         while True:
             chunk = fsrc.read(chunksize)
@@ -131,14 +318,14 @@ class EncryptionService:
                 chunk += b' ' * (16 - len(chunk) % 16)
 
             # Write the chunk
-            fdst.write(cipher.encrypt(chunk))
+            fdst.write(encrypt(chunk))
 
-        # 8. Write the correct filesize.
+        # 7. Write the correct filesize.
         fdst_endpos = fdst.tell()
         fdst.seek(fdst_startpos)
         fdst.write(struct.pack('<Q', filesize))
 
-        # 9. Seek back to end of the file
+        # 8. Seek back to end of the file
         fdst.seek(fdst_endpos)
 
     def decrypt(self, key, data):
@@ -147,39 +334,51 @@ class EncryptionService:
         :raises ValueError: if it can't decrypt the data.
         """
         # 1. Extract the encryption key
-        encryptionKey = self._bytesToKey(self.getEncryptionKey(key))
-        # 2. Create a cipher object
-        cipher = self.CipherFactory.new(
-            key=encryptionKey, mode=self.CipherMode,
-            IV=self.initializationVector)
-        # 3. Decrypt the data.
-        text = cipher.decrypt(data)
-
-        # 4. Remove padding and return result.
+        encryptionKey = self._getDerivedKey(key)
+        # 2. Decrypt the data
+        return self._decrypt(encryptionKey, data)
+
+    def _decrypt(self, encryptionKey, data):
+        # 1. Create a cipher object
+        decrypt = self.backend.cbcDecryptor(
+            encryptionKey, self.initializationVector)
+        # 2. Decrypt the data.
+        text = decrypt(data)
+
+        # 3. Remove padding and return result.
         return self._pkcs7Decode(text)
 
+    def decrypt_many(self, key, messages):
+        """See interfaces.IEncryptionService
+
+        :raises ValueError: if it can't decrypt one of the messages.
+        """
+        encryptionKey = self._getDerivedKey(key)
+        return self._many(self._decrypt, encryptionKey, messages)
+
     def decrypt_file(self, key, fsrc, fdst, chunksize=24 * 1024):
         """ Decrypts a file using with the given key.
         Parameters are similar to encrypt_file.
 
         :raises ValueError: if it can't decrypt the file.
         """
+        # 1. Extract the encryption key
+        encryptionKey = self._getDerivedKey(key)
+        # 2. Decrypt the file
+        self._decryptFile(encryptionKey, fsrc, fdst, chunksize)
+
+    def _decryptFile(self, encryptionKey, fsrc, fdst, chunksize=24 * 1024):
         origsize = struct.unpack('<Q', fsrc.read(struct.calcsize('Q')))[0]
         iv = fsrc.read(16)
 
-        # 1. Extract the encryption key
-        encryptionKey = self._bytesToKey(self.getEncryptionKey(key))
-        # 2. Create a cipher object
-        cipher = self.CipherFactory.new(
-            key=encryptionKey, mode=self.CipherMode,
-            IV=iv
-        )
+        # 1. Create a cipher object
+        decrypt = self.backend.cbcDecryptor(encryptionKey, iv)
 
         while True:
             chunk = fsrc.read(chunksize)
             if len(chunk) == 0:
                 break
-            fdst.write(cipher.decrypt(chunk))
+            fdst.write(decrypt(chunk))
 
         fdst.truncate(origsize)
 
@@ -195,10 +394,38 @@ class KeyManagementFacility(EncryptionService):
 
     keyLength = rsaKeyLength // 16
 
+    # The scheme used for new key encrypting keys: 'rsa' or 'ecc'. Keys of
+    # both schemes can always be used, independent of this setting.
+    keyScheme = 'rsa'
+    eccCurve = 'P-256'  # or, for example, 'X25519'
+    # The passphrase is not a secret, so a costly derivation of the key
+    # protecting the exported private key would not add any security.
+    eccKeyProtection = 'PBKDF2WithHMAC-SHA256AndAES128-CBC'
+    eccKeyIterations = 1000
+
+    # A ``keas.kmi.replication.ChangeLog`` recording all changes, if any.
+    changelog = None
+
+    # Seconds to remember that a key is unknown, and how many such keys.
+    negativeTimeout = 5
+    negativeCacheSize = 10000
+
+    # How new keys are written to disk: 'none', 'fsync' or 'group'; see
+    # ``keas.kmi.durability``.
+    durability = 'fsync'
+
     def __init__(self, storage_dir):
         self.storage_dir = storage_dir
+        _durability.recover(storage_dir)
+        self.__journal = None
+        self.__journalLock = threading.Lock()
+        self.unknownKeys = NegativeCache(
+            self.negativeTimeout, self.negativeCacheSize)
         self.__data_cache = {}
         self.__dek_cache = {}
+        self.__proofs = {}
+        # The names of the stored keys, once listed by ``warm()``
+        self.__names = None
 
     def keys(self):
         return [filename[:-4] for filename in os.listdir(self.storage_dir)
@@ -207,16 +434,46 @@ class KeyManagementFacility(EncryptionService):
     def __iter__(self):
         return iter(self.keys())
 
+    def warm(self):
+        """Remember the names of all stored keys.
+
+        Lookups of these keys no longer list the storage directory. Only
+        the names are kept, the keys are read when first used.
+
+        Returns the number of names not known before.
+        """
+        names = set(self.keys())
+        known = self.__names or set()
+        self.__names = names
+        return len(names - known)
+
     def __getitem__(self, name):
         if name in self.__data_cache:
             return self.__data_cache[name]
-        if name + '.dek' not in os.listdir(self.storage_dir):
+        if self.unknownKeys.hit(name):
             raise KeyError(name)
+        names = self.__names
+        if names is None or name not in names:
+            # The key may have been added by another process.
+            with tracing.phase('listdir'):
+                known = name + '.dek' in os.listdir(self.storage_dir)
+            if not known:
+                self.unknownKeys.add(name)
+                raise KeyError(name)
+            if names is not None:
+                names.add(name)
         fn = os.path.join(self.storage_dir, name + '.dek')
-        with open(fn, 'rb') as file:
-            data = file.read()
-            self.__data_cache[name] = data
-            return data
+        try:
+            with tracing.phase('read'), open(fn, 'rb') as file:
+                data = file.read()
+        except FileNotFoundError:
+            # Removed by another process.
+            if names is not None:
+                names.discard(name)
+            self.unknownKeys.add(name)
+            raise KeyError(name)
+        self.__data_cache[name] = data
+        return data
 
     def get(self, name, default=None):
         try:
@@ -238,60 +495,229 @@ class KeyManagementFacility(EncryptionService):
 
     has_key = __contains__
 
+    @property
+    def journal(self):
+        """The journal used for group commits, created when needed."""
+        with self.__journalLock:
+            if self.__journal is None:
+                self.__journal = _durability.Journal(self.storage_dir)
+            return self.__journal
+
+    def close(self):
+        """Sync and remove the journal, if any."""
+        with self.__journalLock:
+            if self.__journal is not None:
+                self.__journal.close()
+                self.__journal = None
+
     def __setitem__(self, name, key):
+        if self.durability not in _durability.DURABILITY_LEVELS:
+            raise ValueError('Unknown durability: %r' % self.durability)
         fn = os.path.join(self.storage_dir, name + '.dek')
-        with open(fn, 'wb') as file:
-            file.write(key)
+        sync = self.durability == 'fsync'
+        with tracing.phase('write'):
+            _durability.writeFile(fn, key, sync=sync)
+        if self.changelog is not None:
+            # A key that survives a crash must reach the replicas as well.
+            self.changelog.add(name, key, sync=sync)
+        if self.durability == 'group':
+            # Returns when this and all concurrently added keys are durable,
+            # together with the change log.
+            with tracing.phase('journal'):
+                self.journal.add(name, key, self.changelog)
+        if self.__names is not None:
+            self.__names.add(name)
+        self.unknownKeys.discard(name)
         logger.info('New key added (hash): %s', name)
 
     def __delitem__(self, name):
         if name in self.__data_cache:
             del self.__data_cache[name]
+        # Stop handing out the encryption key as well.
+        self.__dek_cache.pop(name, None)
+        self.__proofs.pop(name, None)
+        if self.__names is not None:
+            self.__names.discard(name)
         fn = os.path.join(self.storage_dir, name + '.dek')
         os.remove(fn)
+        if self.changelog is not None:
+            self.changelog.remove(name, sync=self.durability == 'fsync')
+        if self.__journal is not None:
+            # Otherwise the key would be restored after a crash.
+            self.__journal.remove(name, self.changelog)
         logger.info('Key removed (hash): %s', name)
 
     def generate(self):
         """See interfaces.IKeyGenerationService"""
-        # 1. Generate the private/public RSA key encrypting key
-        rsa = Crypto.PublicKey.RSA.generate(
-            self.rsaKeyLength, e=self.rsaKeyExponent)
-        # 2. Extract the private key from the RSA object
-        privateKey = rsa.exportKey(passphrase=self.rsaPassphrase)
-        # 3. Generate the encryption key
-        key = Crypto.Random.new().read(self.keyLength)
-        # 4. Create the lookup key in the container
-        hash = md5()
-        hash.update(privateKey)
-        # 5. Save the encryption key
-        encryptedKey = Crypto.Cipher.PKCS1_v1_5.new(rsa).encrypt(key)
-        self[hash.hexdigest()] = encryptedKey
-        # 6. Return the private key encrypting key
+        # 1. Generate the encryption key
+        key = self.backend.randomBytes(self.keyLength)
+        # 2. Wrap and store it under a new key encrypting key
+        return self._wrapEncryptionKey(key)
+
+    def rewrap(self, key, discard=False):
+        """Store the encryption key of ``key`` under a new key encrypting key.
+
+        The encryption key itself does not change, so all data encrypted
+        with the old key encrypting key can be decrypted with the new one
+        without being touched. If ``discard`` is true, the old entry is
+        removed from the facility.
+
+        Returns the new private key encrypting key.
+        """
+        # 1. Unwrap the encryption key using the old key encrypting key
+        encryptionKey = self.getEncryptionKey(key)
+        # 2. Wrap and store it under a new key encrypting key
+        newKey = self._wrapEncryptionKey(encryptionKey)
+        # 3. Remove the old entry if requested
+        if discard:
+            hash_key = md5(key).hexdigest()
+            del self[hash_key]
+        logger.info('Key rewrapped (hash): %s -> %s',
+                    md5(key).hexdigest(), md5(newKey).hexdigest())
+        return newKey
+
+    def _wrapEncryptionKey(self, key):
+        if self.keyScheme == 'ecc':
+            privateKey, encryptedKey = self._wrapEncryptionKeyECC(key)
+        elif self.keyScheme == 'rsa':
+            privateKey, encryptedKey = self._wrapEncryptionKeyRSA(key)
+        else:
+            raise ValueError('Unknown key scheme: %r' % self.keyScheme)
+        hash_key = md5(privateKey).hexdigest()
+        tracing.annotate(key=hash_key)
+        self[hash_key] = encryptedKey
         return privateKey
 
+    def _wrapEncryptionKeyRSA(self, key):
+        # 1. Generate the private/public RSA key encrypting key, and
+        # 2. extract the private key
+        with tracing.phase('generate'):
+            privateKey, publicKey = self.backend.rsaGenerate(
+                self.rsaKeyLength, self.rsaKeyExponent, self.rsaPassphrase)
+        # 3. Encrypt the encryption key
+        with tracing.phase('wrap'):
+            encryptedKey = self.backend.rsaEncrypt(publicKey, key)
+        # 4. Return the private key encrypting key and the encrypted key
+        return privateKey, encryptedKey
+
+    def _wrapEncryptionKeyECC(self, key):
+        with tracing.phase('generate'):
+            # 1. Generate the private/public EC key encrypting key
+            ecc = ECC.generate(curve=self.eccCurve)
+            # 2. Extract the private key from the ECC object
+            privateKey = ecc.export_key(
+                format='PEM', passphrase=self.rsaPassphrase,
+                protection=self.eccKeyProtection,
+                prot_params={'iteration_count': self.eccKeyIterations},
+            ).encode()
+        with tracing.phase('wrap'):
+            # 3. Agree on a wrapping key with an ephemeral key pair (ECIES)
+            ephemeral = ECC.generate(curve=self.eccCurve)
+            wrappingKey = DH.key_agreement(
+                eph_priv=ephemeral, static_pub=ecc.public_key(),
+                kdf=_eciesKDF)
+            ephemeralKey = ephemeral.public_key().export_key(format='DER')
+            # 4. Encrypt the encryption key
+            nonce = self.backend.randomBytes(12)
+            cipher = AES.new(wrappingKey, AES.MODE_GCM, nonce=nonce)
+            cipher.update(ECIES_MAGIC)
+            encrypted, tag = cipher.encrypt_and_digest(key)
+            encryptedKey = b''.join([
+                ECIES_MAGIC, struct.pack('<H', len(ephemeralKey)),
+                ephemeralKey, nonce, tag, encrypted])
+        # 5. Return the private key encrypting key and the encrypted key
+        return privateKey, encryptedKey
+
+    def _unwrapEncryptionKey(self, key, encryptedKey):
+        # The scheme is detected from the stored key, so keys of all schemes
+        # keep working when the scheme of the facility is changed.
+        if encryptedKey.startswith(ECIES_MAGIC):
+            return self._unwrapEncryptionKeyECC(key, encryptedKey)
+        return self._unwrapEncryptionKeyRSA(key, encryptedKey)
+
+    def _unwrapEncryptionKeyRSA(self, key, encryptedKey):
+        return self.backend.rsaDecrypt(key, self.rsaPassphrase, encryptedKey)
+
+    def _unwrapEncryptionKeyECC(self, key, encryptedKey):
+        pos = len(ECIES_MAGIC)
+        size = struct.unpack('<H', encryptedKey[pos:pos + 2])[0]
+        pos += 2
+        ephemeralKey = encryptedKey[pos:pos + size]
+        pos += size
+        nonce = encryptedKey[pos:pos + 12]
+        tag = encryptedKey[pos + 12:pos + 28]
+        encrypted = encryptedKey[pos + 28:]
+        try:
+            with tracing.phase('importKey'):
+                ecc = ECC.import_key(key, self.rsaPassphrase)
+            with tracing.phase('decrypt'):
+                wrappingKey = DH.key_agreement(
+                    static_priv=ecc, eph_pub=ECC.import_key(ephemeralKey),
+                    kdf=_eciesKDF)
+                cipher = AES.new(wrappingKey, AES.MODE_GCM, nonce=nonce)
+                cipher.update(ECIES_MAGIC)
+                return cipher.decrypt_and_verify(encrypted, tag)
+        except (ValueError, TypeError):
+            raise ValueError('Error while decrypting key.')
+
+    def getCachedEncryptionKey(self, key):
+        """Return the encryption key if it is cached, otherwise ``None``.
+
+        This never touches the disk or does any expensive crypto operation.
+        """
+        hash_key = md5(key).hexdigest()
+        if (hash_key in self.__dek_cache and
+                self.__dek_cache[hash_key][0] + self.timeout > time.time()):
+            return self.__dek_cache[hash_key][1]
+        return None
+
+    def getCachedEncryptionKeyByHash(self, hash_key, proof):
+        """Return a cached encryption key given the hash of its key encrypting
+        key and the proof of possessing it (see ``keyProof()``).
+
+        Raises a ``KeyError`` if the key is not cached or the proof is wrong.
+        """
+        expected = self.__proofs.get(hash_key)
+        if (expected is None or
+                not hmac.compare_digest(expected, proof) or
+                self.cacheTimeLeft(hash_key) <= 0):
+            raise KeyError(hash_key)
+        return self.__dek_cache[hash_key][1]
+
+    def cacheTimeLeft(self, hash_key):
+        """Return the number of seconds a cached encryption key stays valid."""
+        if hash_key not in self.__dek_cache:
+            return 0
+        return max(
+            0, int(self.__dek_cache[hash_key][0] + self.timeout - time.time()))
+
+    def cacheEncryptionKey(self, key, encryptionKey):
+        """Add an encryption key that was decrypted elsewhere to the cache."""
+        hash_key = md5(key).hexdigest()
+        self.__dek_cache[hash_key] = (time.time(), encryptionKey)
+        self.__proofs[hash_key] = keyProof(key)
+
     def getEncryptionKey(self, key):
         """Given the key encrypting key, get the encryption key."""
         # 1. Create the lookup key in the container
         hash = md5()
         hash.update(key)
         hash_key = hash.hexdigest()
+        tracing.annotate(key=hash_key)
         # 2. Try to look up the key in the cache first.
-        if (hash_key in self.__dek_cache and
-                self.__dek_cache[hash_key][0] + self.timeout > time.time()):
-            return self.__dek_cache[hash_key][1]
+        decryptedKey = self.getCachedEncryptionKey(key)
+        if decryptedKey is not None:
+            tracing.annotate(cached=True)
+            return decryptedKey
         # 3. Extract the encrypted encryption key
         encryptedKey = self[hash_key]
         # 4. Decrypt the key.
-        rsa = Crypto.PublicKey.RSA.importKey(key, self.rsaPassphrase)
-        error = object()
-        decryptedKey = Crypto.Cipher.PKCS1_v1_5.new(rsa).decrypt(
-            encryptedKey, error)
-        if decryptedKey is error:
-            raise ValueError('Error while decrypting key.')
+        decryptedKey = self._unwrapEncryptionKey(key, encryptedKey)
         # 5. Return decrypted encryption key
         logger.info('Encryption key requested: %s', hash_key)
         # 6. Add the key to the cache
         self.__dek_cache[hash_key] = (time.time(), decryptedKey)
+        self.__proofs[hash_key] = keyProof(key)
         # 7. Return the key
         return decryptedKey
 
@@ -304,39 +730,176 @@ class LocalKeyManagementFacility(EncryptionService):
     """A local facility that requests keys from the master facility."""
 
     timeout = 3600
+    # Seconds to wait for a server before trying another one
+    requestTimeout = 10
+    # The maximum number of cached encryption keys, or None for no limit
+    cacheSize = None
+    compact = True
+    # Seconds to remember that the server does not know a key, and how many
+    # such keys. The server may ask for a shorter time.
+    negativeTimeout = 5
+    negativeCacheSize = 1000
     httpConnFactory = HTTPConnection
     httpsConnFactory = HTTPSConnection
 
-    def __init__(self, url):
-        self.url = url
-        self.__cache = {}
-
-    def generate(self):
-        """See interfaces.IKeyGenerationService"""
-        pieces = urlparse(self.url)
-        if self.url.startswith('http://'):
-            conn = self.httpConnFactory(pieces.netloc)
-        else:
-            conn = self.httpsConnFactory(pieces.netloc)
-        conn.request('POST', '/new', b'', {})
+    def __init__(self, url, cache=None):
+        # Several URLs of equivalent servers may be given, for example of
+        # read replicas; requests go to the fastest available one.
+        self.urls = [url] if isinstance(url, str) else list(url)
+        self.url = self.urls[0]
+        self.endpoints = EndpointPool(self.urls, probe=self._probe)
+        self.cache = cache
+        self.unknownKeys = NegativeCache(
+            self.negativeTimeout, self.negativeCacheSize)
+        self.__cache = collections.OrderedDict()
+        self.__ttls = {}
+        self.__lock = threading.Lock()
+
+    def _connection(self, url):
+        pieces = urlparse(url)
+        if pieces.scheme == 'https':
+            return self.httpsConnFactory(
+                pieces.netloc, timeout=self.requestTimeout)
+        return self.httpConnFactory(
+            pieces.netloc, timeout=self.requestTimeout)
+
+    def _send(self, url, method, path, body, headers):
+        conn = self._connection(url)
+        conn.request(method, path, body, headers)
         response = conn.getresponse()
         data = response.read()
         response.close()
+        return response, data
+
+    def _request(self, url, method, path, body=None, headers=None):
+        response, data = self._send(url, method, path, body, headers or {})
+        if response.status >= 500:
+            raise EndpointError('{} {} from {}'.format(
+                response.status, response.reason, url))
+        return response, data
+
+    def _probe(self, url):
+        self._request(url, 'GET', '/')
+
+    def generate(self):
+        """See interfaces.IKeyGenerationService"""
+        # Every request creates a key, so a slow or failed request is not
+        # sent again: the key might have been created and would be lost.
+        response, data = self.endpoints.call(
+            lambda url: self._request(url, 'POST', '/new', b''),
+            idempotent=False)
         return data
 
+    def getCachedEncryptionKey(self, key):
+        """Return the encryption key if it is cached, otherwise ``None``."""
+        cached = self.__cache.get(key)
+        if cached is not None and cached[0] + self.__ttl(key) > time.time():
+            return cached[1]
+        return None
+
+    def _cacheTimeLeft(self, key):
+        cached = self.__cache.get(key)
+        if cached is None:
+            return 0
+        return max(0, int(cached[0] + self.__ttl(key) - time.time()))
+
+    def __store(self, key, cached, ttl=None):
+        with self.__lock:
+            self.__cache[key] = cached
+            self.__cache.move_to_end(key)
+            self.__ttls[key] = ttl
+            while (self.cacheSize is not None and
+                   len(self.__cache) > self.cacheSize):
+                oldest, _ = self.__cache.popitem(last=False)
+                self.__ttls.pop(oldest, None)
+
     def getEncryptionKey(self, key):
         """Given the key encrypting key, get the encryption key."""
-        if (key in self.__cache and
-                self.__cache[key][0] + self.timeout > time.time()):
-            return self.__cache[key][1]
-        pieces = urlparse(self.url)
-        conn = self.httpConnFactory(pieces.netloc)
-        conn.request('POST', '/key', key, {'content-type': 'text/plain'})
-        response = conn.getresponse()
-        encryptionKey = response.read()
-        response.close()
-        self.__cache[key] = (time.time(), encryptionKey)
+        encryptionKey = self.getCachedEncryptionKey(key)
+        if encryptionKey is not None:
+            tracing.annotate(cached=True)
+            return encryptionKey
+        # Warm the memory cache from the persistent cache, if there is one.
+        if self.cache is not None:
+            with tracing.phase('persistentCache'):
+                cached = self.cache.get(key, self.timeout)
+            if cached is not None:
+                fetched, encryptionKey, ttl = cached
+                self.__store(key, (fetched, encryptionKey), ttl)
+                return encryptionKey
+        hash_key = md5(key).hexdigest()
+        tracing.annotate(key=hash_key)
+        if self.unknownKeys.hit(hash_key):
+            raise KeyError(hash_key)
+        with tracing.phase('fetch'):
+            encryptionKey, ttl = self._fetchEncryptionKey(key)
+        if encryptionKey is None:
+            self.unknownKeys.add(hash_key, ttl)
+            raise KeyError(hash_key)
+        cached = (time.time(), encryptionKey)
+        self.__store(key, cached, ttl)
+        if self.cache is not None:
+            self.cache.set(key, encryptionKey, cached[0], ttl)
         return encryptionKey
 
+    def __ttl(self, key):
+        # The master may ask us to cache a key for a shorter time.
+        ttl = self.__ttls.get(key)
+        return self.timeout if ttl is None else min(ttl, self.timeout)
+
+    def _maxAge(self, response):
+        match = re.search(
+            r'max-age=(\d+)', response.getheader('Cache-Control') or '')
+        return int(match.group(1)) if match else None
+
+    def _fetchEncryptionKey(self, key):
+        previous = self.__cache.get(key)
+        return self.endpoints.call(
+            lambda url: self._fetchEncryptionKeyFrom(url, key, previous))
+
+    def _fetchEncryptionKeyFrom(self, url, key, previous):
+        if self.compact and previous is not None:
+            # The master has most likely decrypted the key recently, so try
+            # to avoid sending the key encrypting key itself.
+            hash_key = md5(key).hexdigest()
+            body = '{} {}'.format(hash_key, keyProof(key)).encode('ascii')
+            headers = {
+                'content-type': COMPACT_REQUEST_TYPE,
+                'accept': COMPACT_RESPONSE_TYPE,
+                'if-none-match': '"%s"' % hash_key}
+            response, encryptionKey = self._request(
+                url, 'POST', '/key', body, headers)
+            if response.status == 304:
+                return previous[1], self._maxAge(response)
+            if response.status == 200:
+                return encryptionKey, self._maxAge(response)
+        response, encryptionKey = self._request(url, 'POST', '/key', key, {
+            'content-type': 'text/plain',
+            'accept': COMPACT_RESPONSE_TYPE})
+        if response.status == 404:
+            # Not an error of the server, so no other server is tried.
+            return None, self._maxAge(response)
+        return encryptionKey, self._maxAge(response)
+
+    def invalidate(self, key=None):
+        """Forget the cached encryption key of ``key``.
+
+        If no key is given, all cached encryption keys are forgotten.
+        """
+        if key is None:
+            self.__cache.clear()
+            self.__ttls.clear()
+            self.unknownKeys.clear()
+            if self.cache is not None:
+                self.cache.clear()
+        else:
+            self.__cache.pop(key, None)
+            self.__ttls.pop(key, None)
+            self.unknownKeys.discard(md5(key).hexdigest())
+            if self.cache is not None:
+                self.cache.invalidate(key)
+
     def __repr__(self):
-        return '<{} {!r}>'.format(self.__class__.__name__, self.url)
+        return '<{} {!r}>'.format(
+            self.__class__.__name__,
+            self.url if len(self.urls) == 1 else self.urls)
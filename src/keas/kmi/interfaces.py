@@ -27,6 +27,15 @@ class IEncryptionService(zope.interface.Interface):
     def decrypt(key, data):
         """Returns the decrypted data"""
 
+    def encrypt_many(key, messages):
+        """Returns a list of the encrypted messages.
+
+        The encryption key is looked up only once for all of them.
+        """
+
+    def decrypt_many(key, messages):
+        """Returns a list of the decrypted messages."""
+
     def encrypt_file(key, fsrc, fdst, chunksize):
         """ """
 
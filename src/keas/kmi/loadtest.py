@@ -0,0 +1,387 @@
+##############################################################################
+#
+# Copyright (c) 2008 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Load generator for Key Management Servers.
+"""
+import collections
+import math
+import optparse
+import random
+import socketserver
+import sys
+import tempfile
+import textwrap
+import threading
+import time
+from wsgiref.simple_server import WSGIRequestHandler
+from wsgiref.simple_server import WSGIServer
+from wsgiref.simple_server import make_server
+
+from keas.kmi.facility import LocalKeyManagementFacility
+
+
+# The kinds of requests and their paths
+KINDS = {
+    'new': 'POST /new',
+    'key': 'POST /key',
+    'status': 'GET /',
+}
+
+
+def percentile(values, p):
+    """Return the ``p``-th percentile of the sorted ``values``.
+
+    The nearest-rank method is used, so the result is one of the values.
+    """
+    if not values:
+        return None
+    rank = max(1, math.ceil(p / 100 * len(values)))
+    return values[rank - 1]
+
+
+class Statistics:
+    """Latencies and errors of the requests of a run, by kind."""
+
+    percentiles = (50, 90, 99)
+
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.elapsed = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, kind, seconds, error=False):
+        with self._lock:
+            if error:
+                self.errors[kind] += 1
+            else:
+                self.latencies[kind].append(seconds)
+
+    def count(self, kind=None):
+        if kind is None:
+            return sum(self.count(kind) for kind in self.kinds())
+        return len(self.latencies[kind]) + self.errors[kind]
+
+    def kinds(self):
+        return sorted(set(self.latencies) | set(self.errors))
+
+    def summary(self, kind):
+        """Return the throughput and latency percentiles of a kind."""
+        latencies = sorted(self.latencies[kind])
+        result = {
+            'requests': self.count(kind),
+            'errors': self.errors[kind],
+            'throughput': self.count(kind) / (self.elapsed or 1e-9),
+            'max': latencies[-1] if latencies else None,
+        }
+        for p in self.percentiles:
+            result['p%d' % p] = percentile(latencies, p)
+        return result
+
+    def report(self, title=None):
+        lines = [] if title is None else [title]
+        for kind in self.kinds():
+            summary = self.summary(kind)
+            line = '%-7s %6d requests %4d errors %8.1f req/s' % (
+                kind, summary['requests'], summary['errors'],
+                summary['throughput'])
+            for name in ['p%d' % p for p in self.percentiles] + ['max']:
+                if summary[name] is not None:
+                    line += '  %s %.1fms' % (name, summary[name] * 1000)
+            lines.append(line)
+        lines.append('total   %6d requests in %.2f s' % (
+            self.count(), self.elapsed))
+        return '\n'.join(lines)
+
+
+class LoadGenerator:
+    """Send a mix of requests to a server and measure their latency.
+
+    ``mix`` maps the kinds of requests (see ``KINDS``) to their weights.
+    Without a ``rate``, ``concurrency`` workers send requests back to back.
+    With a ``rate`` in requests per second, the requests are started on a
+    fixed schedule, and their latency is measured from the scheduled start,
+    so a server that falls behind is not hidden by the waiting workers.
+
+    Key lookups always go to the server; the client side key cache of
+    ``LocalKeyManagementFacility`` is bypassed. A ``seed`` makes the
+    sequence of kinds of requests and of the keys looked up reproducible.
+    """
+
+    def __init__(self, url, mix=None, concurrency=4, rate=None, seed=None):
+        self.kmf = LocalKeyManagementFacility(url)
+        # Always send the key encrypting key itself.
+        self.kmf.compact = False
+        self.mix = mix or {'key': 1}
+        unknown = set(self.mix) - set(KINDS)
+        if unknown:
+            raise ValueError('Unknown request kinds: %s' % ', '.join(
+                sorted(unknown)))
+        self.concurrency = concurrency
+        self.rate = rate
+        self.keys = []
+        self._random = random.Random(seed)
+
+    def prepare(self, count):
+        """Generate the keys used by the key lookups."""
+        self.keys.extend(self.kmf.generate() for i in range(count))
+
+    def send(self, kind, key=None):
+        if kind == 'new':
+            self.kmf.generate()
+        elif kind == 'key':
+            if key is None:
+                key = self._random.choice(self.keys)
+            encryptionKey, ttl = self.kmf._fetchEncryptionKey(key)
+            if encryptionKey is None:
+                raise KeyError('Key not found')
+        else:
+            self.kmf.endpoints.call(
+                lambda url: self.kmf._request(url, 'GET', '/'))
+
+    def _timed(self, statistics, start, kind, key=None):
+        try:
+            self.send(kind, key)
+        except Exception:
+            statistics.add(kind, time.perf_counter() - start, error=True)
+        else:
+            statistics.add(kind, time.perf_counter() - start)
+
+    def run(self, duration=10.0, requests=None):
+        """Send requests for ``duration`` seconds or ``requests`` requests.
+
+        Returns the ``Statistics`` of the run.
+        """
+        if 'key' in self.mix and not self.keys:
+            self.prepare(1)
+        kinds = list(self.mix)
+        weights = [self.mix[kind] for kind in kinds]
+        statistics = Statistics()
+        lock = threading.Lock()
+        counter = iter(range(sys.maxsize if requests is None else requests))
+        start = time.perf_counter()
+        deadline = None if duration is None else start + duration
+
+        def work():
+            while True:
+                with lock:
+                    # Draw everything in the order of the requests, so a
+                    # seed always gives the same requests.
+                    number = next(counter, None)
+                    kind = self._random.choices(kinds, weights)[0]
+                    key = None
+                    if kind == 'key':
+                        key = self._random.choice(self.keys)
+                if number is None:
+                    return
+                if self.rate:
+                    scheduled = start + number / self.rate
+                    if deadline is not None and scheduled >= deadline:
+                        return
+                    delay = scheduled - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                else:
+                    scheduled = time.perf_counter()
+                    if deadline is not None and scheduled >= deadline:
+                        return
+                self._timed(statistics, scheduled, kind, key)
+
+        self._runWorkers(work)
+        statistics.elapsed = time.perf_counter() - start
+        return statistics
+
+    def lookupAll(self, keys):
+        """Look up every key once, returning the ``Statistics``."""
+        statistics = Statistics()
+        todo = iter(keys)
+        lock = threading.Lock()
+
+        def work():
+            while True:
+                with lock:
+                    key = next(todo, None)
+                if key is None:
+                    return
+                self._timed(statistics, time.perf_counter(), 'key', key)
+
+        start = time.perf_counter()
+        self._runWorkers(work)
+        statistics.elapsed = time.perf_counter() - start
+        return statistics
+
+    def compare(self, count):
+        """Compare key lookups while the server's cache is cold and warm.
+
+        New keys are generated, so the server has not decrypted them yet,
+        and each of them is looked up twice. Returns the ``Statistics`` of
+        both passes.
+        """
+        keys = [self.kmf.generate() for i in range(count)]
+        self.keys.extend(keys)
+        return self.lookupAll(keys), self.lookupAll(keys)
+
+    def close(self):
+        self.kmf.endpoints.close()
+
+    def _runWorkers(self, work):
+        threads = [threading.Thread(target=work, name='kmi-load-%d' % i)
+                   for i in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+
+class ThreadingWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+    def get_app(self):
+        app = self.application
+
+        def threaded(environ, start_response):
+            # The request handler of wsgiref always reports a single
+            # threaded server.
+            environ['wsgi.multithread'] = True
+            return app(environ, start_response)
+        return threaded
+
+
+class QuietHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(app, host='127.0.0.1', port=0):
+    """Serve the WSGI application in a background thread.
+
+    Returns the server; its URL is ``http://host:server.server_port``.
+    """
+    server = make_server(host, port, app, ThreadingWSGIServer, QuietHandler)
+    thread = threading.Thread(
+        target=server.serve_forever, name='kmi-server', daemon=True)
+    thread.start()
+    return server
+
+
+def start_server(storage_dir=None, **kw):
+    """Start a server created by ``wsgi.application_factory`` on localhost.
+
+    Returns the server and its URL.
+    """
+    from keas.kmi import wsgi
+    kw['storage-dir'] = storage_dir or tempfile.mkdtemp()
+    server = serve(wsgi.application_factory({}, **kw))
+    return server, 'http://127.0.0.1:%d' % server.server_port
+
+
+def parse_mix(value):
+    """Parse weights like ``key=8,new=1,status=1``."""
+    mix = {}
+    for item in value.split(','):
+        kind, _, weight = item.partition('=')
+        mix[kind.strip()] = float(weight) if weight else 1.0
+    return mix
+
+
+parser = optparse.OptionParser(textwrap.dedent("""\
+     %prog URL
+                send key lookups to the server at URL for 10 seconds
+
+           %prog --in-process -m key=8,new=1,status=1 -c 16
+                start a server on localhost and send a mix of requests
+
+           %prog URL -r 200 -d 60
+                send 200 requests per second for a minute
+
+           %prog URL --compare 100
+                compare lookups of 100 new keys while the server's cache
+                is cold and warm
+    """.rstrip()),
+    description="Load generator for a Key Management Server.")
+parser.add_option(
+    '-i', '--in-process', action='store_true', default=False,
+    help='start a server in this process instead of using URL')
+parser.add_option(
+    '-s', '--storage-dir',
+    help='storage directory of the in-process server (default: temporary)')
+parser.add_option(
+    '-m', '--mix', default='key=1',
+    help='weights of the kinds of requests, new, key and status '
+         '(default: %default)')
+parser.add_option(
+    '-c', '--concurrency', type='int', default=4,
+    help='number of concurrent clients (default: %default)')
+parser.add_option(
+    '-r', '--rate', type='float',
+    help='requests per second, instead of sending them back to back')
+parser.add_option(
+    '-d', '--duration', type='float', default=10.0,
+    help='seconds to send requests (default: %default)')
+parser.add_option(
+    '-n', '--requests', type='int',
+    help='number of requests to send, instead of a duration')
+parser.add_option(
+    '-k', '--keys', type='int', default=10,
+    help='number of keys to look up (default: %default)')
+parser.add_option(
+    '--seed', type='int',
+    help='seed making the sequence of kinds of requests reproducible')
+parser.add_option(
+    '--compare', type='int', metavar='KEYS',
+    help='compare lookups of KEYS new keys with a cold and a warm cache')
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    opts, args = parser.parse_args(argv)
+    server = None
+    if opts.in_process:
+        if args:
+            parser.error('Do not specify a URL with --in-process')
+        server, url = start_server(opts.storage_dir)
+        print('Started server at %s' % url)
+    elif len(args) == 1:
+        url = args[0]
+    else:
+        parser.error('Please specify the KMS server URL')
+
+    try:
+        generator = LoadGenerator(
+            url, parse_mix(opts.mix), opts.concurrency, opts.rate,
+            opts.seed)
+    except ValueError as e:
+        parser.error(str(e))
+    try:
+        if opts.compare:
+            cold, warm = generator.compare(opts.compare)
+            print(cold.report('Cold cache:'))
+            print(warm.report('Warm cache:'))
+            coldMedian = cold.summary('key')['p50']
+            warmMedian = warm.summary('key')['p50']
+            if coldMedian and warmMedian:
+                print('Median lookup %.1fx faster with a warm cache' % (
+                    coldMedian / warmMedian))
+        else:
+            if 'key' in generator.mix:
+                generator.prepare(opts.keys)
+            duration = None if opts.requests else opts.duration
+            statistics = generator.run(duration, opts.requests)
+            print(statistics.report())
+    finally:
+        generator.close()
+        if server is not None:
+            server.shutdown()
+            server.server_close()
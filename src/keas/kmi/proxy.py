@@ -0,0 +1,139 @@
+##############################################################################
+#
+# Copyright (c) 2008 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Caching proxy in front of the master key management facility
+"""
+import collections
+import hmac
+import threading
+from concurrent.futures import Future
+from hashlib import md5
+from http.client import RemoteDisconnected
+
+from keas.kmi.facility import LocalKeyManagementFacility
+from keas.kmi.facility import keyProof
+
+
+class ProxyKeyManagementFacility(LocalKeyManagementFacility):
+    """A local facility serving the REST API to the clients of a site.
+
+    The encryption keys fetched from the master are cached for all clients
+    in a bounded cache. Connections to the master are kept open and reused,
+    and concurrent requests for the same key result in a single request to
+    the master.
+    """
+
+    cacheSize = 10000
+    # The maximum number of idle connections kept open per server
+    poolSize = 8
+
+    def __init__(self, url, cache=None):
+        super().__init__(url, cache)
+        self._hashes = collections.OrderedDict()
+        self._idle = collections.defaultdict(list)
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def _send(self, url, method, path, body, headers):
+        with self._lock:
+            idle = self._idle[url]
+            conn = idle.pop() if idle else None
+        if conn is not None:
+            try:
+                return self._sendOn(url, conn, method, path, body, headers)
+            except (RemoteDisconnected, ConnectionResetError,
+                    BrokenPipeError):
+                # The server closed the idle connection, use a new one.
+                pass
+        conn = self._connection(url)
+        return self._sendOn(url, conn, method, path, body, headers)
+
+    def _sendOn(self, url, conn, method, path, body, headers):
+        try:
+            conn.request(method, path, body, headers)
+            response = conn.getresponse()
+            data = response.read()
+        except BaseException:
+            conn.close()
+            raise
+        response.close()
+        with self._lock:
+            idle = self._idle[url]
+            if (getattr(response, 'will_close', False) or
+                    len(idle) >= self.poolSize):
+                conn.close()
+            else:
+                idle.append(conn)
+        return response, data
+
+    def _fetchEncryptionKey(self, key):
+        # Only the first of several concurrent requests for the same key
+        # asks the master, the others wait for its result.
+        with self._lock:
+            future = self._pending.get(key)
+            owner = future is None
+            if owner:
+                future = self._pending[key] = Future()
+        if not owner:
+            return future.result()
+        try:
+            result = super()._fetchEncryptionKey(key)
+        except BaseException as error:
+            future.set_exception(error)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._pending[key]
+
+    def getEncryptionKey(self, key):
+        encryptionKey = super().getEncryptionKey(key)
+        with self._lock:
+            # Remember the key encrypting key for the compact protocol.
+            hash_key = md5(key).hexdigest()
+            self._hashes[hash_key] = key
+            self._hashes.move_to_end(hash_key)
+            while len(self._hashes) > self.cacheSize:
+                self._hashes.popitem(last=False)
+        return encryptionKey
+
+    def getCachedEncryptionKeyByHash(self, hash_key, proof):
+        """See ``KeyManagementFacility.getCachedEncryptionKeyByHash()``"""
+        key = self._hashes.get(hash_key)
+        if (key is None or
+                not hmac.compare_digest(keyProof(key), proof)):
+            raise KeyError(hash_key)
+        encryptionKey = self.getCachedEncryptionKey(key)
+        if encryptionKey is None:
+            raise KeyError(hash_key)
+        return encryptionKey
+
+    def cacheTimeLeft(self, hash_key):
+        """Return the number of seconds a cached encryption key stays valid."""
+        key = self._hashes.get(hash_key)
+        return 0 if key is None else self._cacheTimeLeft(key)
+
+    def close(self):
+        """Close all idle connections and stop the endpoint threads."""
+        with self._lock:
+            connections = [conn for idle in self._idle.values()
+                           for conn in idle]
+            self._idle.clear()
+        for conn in connections:
+            conn.close()
+        self.endpoints.close()
+
+    def __len__(self):
+        return len(self._hashes)
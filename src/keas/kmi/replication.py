@@ -0,0 +1,240 @@
+##############################################################################
+#
+# Copyright (c) 2008 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Replication of the master key store to read replicas
+"""
+import base64
+import logging
+import os
+import threading
+from hashlib import md5
+from http.client import HTTPConnection
+from http.client import HTTPSConnection
+from urllib.parse import urlparse
+
+from keas.kmi.facility import KeyManagementFacility
+
+
+logger = logging.getLogger('kmi')
+
+
+class ChangeLog:
+    """An append-only log of the changes to a facility's storage directory.
+
+    Every line records one added or removed key. Positions in the log are
+    byte offsets, so readers can continue where they stopped.
+    """
+
+    filename = 'changes.log'
+
+    def __init__(self, storage_dir):
+        self.path = os.path.join(storage_dir, self.filename)
+        self._lock = threading.Lock()
+        if not os.path.exists(self.path):
+            # Record the keys that already exist, so replicas get them too.
+            kmf = KeyManagementFacility(storage_dir)
+            with open(self.path, 'wb') as file:
+                for name in kmf.keys():
+                    file.write(self._format('add', name, kmf[name]))
+
+    def _format(self, action, name, key=None):
+        line = '{} {}'.format(action, name)
+        if key is not None:
+            line += ' ' + base64.b64encode(key).decode('ascii')
+        return (line + '\n').encode('ascii')
+
+    def _append(self, line, sync=False):
+        with self._lock:
+            with open(self.path, 'ab') as file:
+                file.write(line)
+                if sync:
+                    file.flush()
+                    os.fsync(file.fileno())
+
+    def add(self, name, key, sync=False):
+        """Record a new key; with ``sync``, it is on disk when returning."""
+        self._append(self._format('add', name, key), sync)
+
+    def remove(self, name, sync=False):
+        self._append(self._format('del', name), sync)
+
+    def sync(self):
+        """Make all recorded changes durable."""
+        with open(self.path, 'ab') as file:
+            os.fsync(file.fileno())
+
+    def size(self):
+        return os.path.getsize(self.path)
+
+    def read(self, position=0, limit=1024 * 1024):
+        """Return the log data after ``position`` and the new position.
+
+        At most ``limit`` bytes are returned, but always complete lines only.
+        """
+        with open(self.path, 'rb') as file:
+            file.seek(position)
+            data = file.read(limit)
+        end = data.rfind(b'\n') + 1
+        if end == 0 and len(data) == limit:
+            # A single line longer than the limit; return it anyway.
+            with open(self.path, 'rb') as file:
+                file.seek(position)
+                data = file.readline()
+            end = len(data) if data.endswith(b'\n') else 0
+        return data[:end], position + end
+
+
+def parse_changes(data):
+    """Yield ``(action, name, key)`` tuples from change log data."""
+    for line in data.decode('ascii').splitlines():
+        action, name, *rest = line.split(' ')
+        key = base64.b64decode(rest[0]) if rest else None
+        yield action, name, key
+
+
+class ReplicaKeyManagementFacility(KeyManagementFacility):
+    """A read replica of a master key management facility.
+
+    The replica serves encryption keys from its own storage directory and
+    pulls new and removed keys from the change log of the primary. Its
+    position in the change log is stored, so after a downtime the replica
+    catches up with everything it missed. New keys are generated by the
+    primary.
+    """
+
+    httpConnFactory = HTTPConnection
+    httpsConnFactory = HTTPSConnection
+    positionFile = 'replica.position'
+    batchSize = 1024 * 1024
+    requestTimeout = 10
+
+    def __init__(self, storage_dir, url):
+        super().__init__(storage_dir)
+        self.url = url
+        self._syncLock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def position(self):
+        try:
+            with open(os.path.join(self.storage_dir, self.positionFile)) as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return 0
+
+    @position.setter
+    def position(self, value):
+        path = os.path.join(self.storage_dir, self.positionFile)
+        with open(path + '.tmp', 'w') as file:
+            file.write(str(value))
+        os.replace(path + '.tmp', path)
+
+    def _connection(self):
+        pieces = urlparse(self.url)
+        if pieces.scheme == 'https':
+            return self.httpsConnFactory(
+                pieces.netloc, timeout=self.requestTimeout)
+        return self.httpConnFactory(
+            pieces.netloc, timeout=self.requestTimeout)
+
+    def sync(self):
+        """Apply all changes of the primary not seen yet.
+
+        Returns the number of applied changes.
+        """
+        count = 0
+        with self._syncLock:
+            position = self.position
+            conn = self._connection()
+            while True:
+                conn.request('GET', '/changes?since=%d&limit=%d' % (
+                    position, self.batchSize))
+                response = conn.getresponse()
+                data = response.read()
+                response.close()
+                if response.status != 200:
+                    raise OSError('Cannot read changes from %s: %s %s' % (
+                        self.url, response.status, response.reason))
+                newPosition = int(response.getheader('X-KMI-Position'))
+                for action, name, key in parse_changes(data):
+                    if action == 'add':
+                        self[name] = key
+                    elif name in self:
+                        del self[name]
+                    count += 1
+                if newPosition == position:
+                    break
+                self.position = position = newPosition
+        return count
+
+    def generate(self):
+        """See interfaces.IKeyGenerationService
+
+        Keys are generated by the primary and replicated immediately.
+        """
+        conn = self._connection()
+        conn.request('POST', '/new', b'', {})
+        response = conn.getresponse()
+        data = response.read()
+        response.close()
+        if response.status != 200:
+            raise OSError('Cannot generate a key at %s: %s %s' % (
+                self.url, response.status, response.reason))
+        # The key exists on the primary now, so it must reach the client.
+        # If replicating it fails, the next lookup or sync fetches it.
+        try:
+            self.sync()
+        except OSError:
+            logger.warning('Replication from %s failed', self.url)
+        return data
+
+    def getEncryptionKey(self, key):
+        # Do not ask the primary again for keys it recently did not know.
+        recentlyUnknown = md5(key).hexdigest() in self.unknownKeys
+        try:
+            return super().getEncryptionKey(key)
+        except KeyError:
+            if recentlyUnknown:
+                raise
+        # The key may have been created after the last synchronization.
+        try:
+            self.sync()
+        except OSError:
+            logger.warning('Replication from %s failed', self.url)
+        return super().getEncryptionKey(key)
+
+    def _run(self, interval):
+        while not self._stopped.wait(interval):
+            try:
+                self.sync()
+            except Exception:
+                logger.exception('Replication from %s failed', self.url)
+
+    def start(self, interval=1.0):
+        """Synchronize with the primary in a background thread."""
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run, args=(interval,), name='kmi-replica',
+            daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __repr__(self):
+        return '<{} ({}) {!r}>'.format(
+            self.__class__.__name__, len(self), self.url)
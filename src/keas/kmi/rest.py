@@ -13,9 +13,15 @@
 ##############################################################################
 """REST-API to master key management facility
 """
+from hashlib import md5
+
 from webob import Response
 from webob import exc
 
+from keas.kmi import tracing
+from keas.kmi.facility import COMPACT_REQUEST_TYPE
+from keas.kmi.facility import COMPACT_RESPONSE_TYPE
+
 
 def get_status(context, request):
     return Response(
@@ -24,19 +30,79 @@ def get_status(context, request):
         headerlist=[('Content-Type', 'text/plain')])
 
 
-def create_key(context, request):
+def get_changes(context, request):
+    changelog = getattr(context, 'changelog', None)
+    if changelog is None:
+        return exc.HTTPNotFound('No change log')
+    try:
+        since = int(request.params.get('since', 0))
+        limit = int(request.params.get('limit', 1024 * 1024))
+    except ValueError:
+        return exc.HTTPBadRequest('Invalid position')
+    data, position = changelog.read(since, limit)
     return Response(
-        context.generate(),
-        charset='utf-8',
-        headerlist=[('Content-Type', 'text/plain')])
+        data,
+        headerlist=[('Content-Type', 'text/plain'),
+                    ('X-KMI-Position', str(position))])
+
+
+def create_key(context, request):
+    key = context.generate()
+    with tracing.phase('response'):
+        return Response(
+            key,
+            charset='utf-8',
+            headerlist=[('Content-Type', 'text/plain')])
+
+
+def binary_key_response(request, hash_key, encryptionKey, ttl):
+    etag = '"%s"' % hash_key
+    headerlist = [
+        ('Content-Type', COMPACT_RESPONSE_TYPE),
+        ('Cache-Control', 'private, max-age=%d' % ttl),
+        ('ETag', etag)]
+    if request.headers.get('If-None-Match') == etag:
+        return Response(status=304, headerlist=headerlist[1:])
+    return Response(encryptionKey, headerlist=headerlist)
+
+
+def key_not_found(context):
+    response = exc.HTTPNotFound('Key not found')
+    unknownKeys = getattr(context, 'unknownKeys', None)
+    if unknownKeys is not None:
+        # Clients should not ask again before the server does.
+        response.cache_control = 'private, max-age=%d' % unknownKeys.timeout
+    return response
 
 
 def get_key(context, request):
+    if request.content_type == COMPACT_REQUEST_TYPE:
+        return get_cached_key(context, request)
     key = request.body
     try:
+        encryptionKey = context.getEncryptionKey(key)
+    except KeyError:
+        return key_not_found(context)
+    with tracing.phase('response'):
+        if COMPACT_RESPONSE_TYPE in request.headers.get('Accept', ''):
+            hash_key = md5(key).hexdigest()
+            return binary_key_response(
+                request, hash_key, encryptionKey,
+                context.cacheTimeLeft(hash_key))
         return Response(
-            context.getEncryptionKey(key),
+            encryptionKey,
             charset='utf-8',
             headerlist=[('Content-Type', 'text/plain')])
-    except KeyError:
-        return exc.HTTPNotFound('Key not found')
+
+
+def get_cached_key(context, request):
+    try:
+        hash_key, proof = request.body.decode('ascii').split()
+        encryptionKey = context.getCachedEncryptionKeyByHash(hash_key, proof)
+    except (KeyError, ValueError):
+        # The client has to send the key encrypting key itself.
+        return exc.HTTPConflict('Key not cached')
+    tracing.annotate(key=hash_key, cached=True)
+    with tracing.phase('response'):
+        return binary_key_response(
+            request, hash_key, encryptionKey, context.cacheTimeLeft(hash_key))
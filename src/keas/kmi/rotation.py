@@ -0,0 +1,252 @@
+##############################################################################
+#
+# Copyright (c) 2008 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Key rotation: re-encrypt stored data under a new key encrypting key.
+"""
+import collections
+import logging
+import optparse
+import os
+import struct
+import sys
+import textwrap
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from keas.kmi.durability import syncDirectory
+from keas.kmi.facility import KeyManagementFacility
+from keas.kmi.facility import LocalKeyManagementFacility
+
+
+logger = logging.getLogger('kmi')
+
+
+class Checkpoint:
+    """Records the names of items that have been rotated already.
+
+    The checkpoint is a plain text file with one name per line, so an
+    interrupted rotation can be resumed by skipping the recorded items.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.done = set()
+        self._lock = threading.Lock()
+        if os.path.exists(filename):
+            with open(filename) as file:
+                self.done.update(line.rstrip('\n') for line in file)
+            self.done.discard('')
+
+    def __contains__(self, name):
+        return name in self.done
+
+    def __len__(self):
+        return len(self.done)
+
+    def mark(self, name):
+        """Record ``name``; it is on disk when returning."""
+        with self._lock:
+            created = not os.path.exists(self.filename)
+            with open(self.filename, 'a') as file:
+                file.write(name + '\n')
+                file.flush()
+                os.fsync(file.fileno())
+            if created:
+                syncDirectory(os.path.dirname(os.path.abspath(self.filename)))
+            self.done.add(name)
+
+
+class KeyRotation:
+    """Re-encrypt data from one key encrypting key to another.
+
+    The encryption keys are resolved once when the rotation is created.
+    Reading, de- and encryption and writing of the individual items are
+    spread over a pool of worker threads, so they overlap across items.
+    """
+
+    chunksize = 24 * 1024
+
+    def __init__(self, service, oldKey, newKey, workers=4, target=None):
+        self.service = service
+        self.target = service if target is None else target
+        self.workers = workers
+        self.processed = 0
+        self._oldKey = service._getDerivedKey(oldKey)
+        self._newKey = self.target._getDerivedKey(newKey)
+        self._lock = threading.Lock()
+
+    def _count(self):
+        with self._lock:
+            self.processed += 1
+
+    def rotate(self, data):
+        """Re-encrypt a single blob created by ``encrypt()``."""
+        data = self.target._encrypt(
+            self._newKey, self.service._decrypt(self._oldKey, data))
+        self._count()
+        return data
+
+    def rotate_many(self, blobs):
+        """Re-encrypt a stream of blobs, yielding results in input order.
+
+        At most ``2 * workers`` blobs are in flight at any time, so
+        arbitrarily long streams can be processed in constant memory.
+        """
+        window = collections.deque()
+        with ThreadPoolExecutor(self.workers) as pool:
+            for data in blobs:
+                window.append(pool.submit(self.rotate, data))
+                if len(window) >= 2 * self.workers:
+                    yield window.popleft().result()
+            while window:
+                yield window.popleft().result()
+
+    def rotate_file(self, fsrc, fdst):
+        """Re-encrypt a file created by ``encrypt_file()``.
+
+        The file is decrypted and encrypted chunk by chunk, so the plain
+        text is never written anywhere. The padded data is re-encrypted as
+        it is, so the size in front of it stays valid.
+        """
+        header = fsrc.read(struct.calcsize('<Q'))
+        decrypt = self.service.backend.cbcDecryptor(
+            self._oldKey, fsrc.read(16))
+        iv = self.target.backend.randomBytes(16)
+        encrypt = self.target.backend.cbcEncryptor(self._newKey, iv)
+        fdst.write(header)
+        fdst.write(iv)
+        while True:
+            chunk = fsrc.read(self.chunksize)
+            if not chunk:
+                break
+            fdst.write(encrypt(decrypt(chunk)))
+        self._count()
+
+    def _rotate_path(self, path, checkpoint):
+        tmp = path + '.rotating'
+        with open(path, 'rb') as fsrc, open(tmp, 'wb') as fdst:
+            self.rotate_file(fsrc, fdst)
+            fdst.flush()
+            os.fsync(fdst.fileno())
+        # Rotating a file twice would destroy it, so it is recorded first.
+        # After a crash before the rename, the file is still readable with
+        # the old key, and the rename is completed when resuming.
+        checkpoint.mark(path)
+        os.replace(tmp, path)
+        syncDirectory(os.path.dirname(os.path.abspath(path)))
+        return path
+
+    def rotate_files(self, paths, checkpoint):
+        """Re-encrypt files in place.
+
+        Every file is written to a temporary file next to it first, recorded
+        in ``checkpoint``, and then renamed. Files recorded in the
+        checkpoint are skipped, so running the rotation again never rotates
+        a file twice, which would make it unreadable.
+
+        Returns the list of rotated paths.
+        """
+        if checkpoint is None:
+            raise ValueError('Rotating files in place needs a checkpoint')
+        todo = []
+        for path in paths:
+            if path not in checkpoint:
+                todo.append(path)
+            elif os.path.exists(path + '.rotating'):
+                # Interrupted after recording the file.
+                os.replace(path + '.rotating', path)
+        with ThreadPoolExecutor(self.workers) as pool:
+            futures = [pool.submit(self._rotate_path, path, checkpoint)
+                       for path in todo]
+            rotated = [future.result() for future in futures]
+        logger.info('Rotated %d files, skipped %d',
+                    len(rotated), len(paths) - len(rotated))
+        return rotated
+
+
+def read_kek(kekfile):
+    with open(kekfile, 'rb') as fp:
+        return fp.read()
+
+
+def rewrap(kmf, kekfile, discard=False):
+    newKey = kmf.rewrap(read_kek(kekfile), discard=discard)
+    os.write(sys.stdout.fileno(), newKey)
+
+
+def rotate_files(kmf, oldkekfile, newkekfile, *paths,
+                 workers=4, checkpoint=None):
+    if not paths:
+        raise TypeError('no files given')
+    if checkpoint is None:
+        print('Please specify a checkpoint file, files rotated twice '
+              'cannot be decrypted anymore', file=sys.stderr)
+        sys.exit(1)
+    rotation = KeyRotation(
+        kmf, read_kek(oldkekfile), read_kek(newkekfile), workers)
+    rotated = rotation.rotate_files(list(paths), Checkpoint(checkpoint))
+    print('%d files rotated, %d skipped' % (
+        len(rotated), len(paths) - len(rotated)), file=sys.stderr)
+
+
+parser = optparse.OptionParser(textwrap.dedent("""\
+     %prog -u URL -c CHECKPOINT old.txt new.txt FILE...
+                re-encrypt files written by encrypt_file in place
+
+           %prog -s DIR -c CHECKPOINT old.txt new.txt FILE...
+                the same, using the master storage directory directly
+
+           %prog -s DIR --rewrap old.txt > new.txt
+                wrap the encryption key of old.txt under a new key
+                encrypting key without touching any data
+    """.rstrip()),
+    description="Rotate key encrypting keys of a Key Management Server.")
+parser.add_option(
+    '-u', '--url',
+    help='URL of the key management server')
+parser.add_option(
+    '-s', '--storage-dir',
+    help='storage directory of the master key management facility')
+parser.add_option(
+    '-r', '--rewrap', action='store_true', default=False,
+    help='rewrap the stored encryption key under a new key encrypting key')
+parser.add_option(
+    '--discard', action='store_true', default=False,
+    help='remove the old entry after rewrapping')
+parser.add_option(
+    '-j', '--workers', type='int', default=4,
+    help='number of worker threads (default: %default)')
+parser.add_option(
+    '-c', '--checkpoint',
+    help='file recording rotated files, required for rotating files')
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    opts, args = parser.parse_args(argv)
+    if opts.storage_dir:
+        kmf = KeyManagementFacility(opts.storage_dir)
+    elif opts.url and not opts.rewrap:
+        kmf = LocalKeyManagementFacility(opts.url)
+    else:
+        parser.error('Please specify the storage directory or server URL')
+
+    try:
+        if opts.rewrap:
+            rewrap(kmf, *args, discard=opts.discard)
+        else:
+            rotate_files(kmf, *args, workers=opts.workers,
+                         checkpoint=opts.checkpoint)
+    except TypeError:
+        parser.error('incorrect number of arguments')
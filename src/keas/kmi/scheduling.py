@@ -0,0 +1,167 @@
+##############################################################################
+#
+# Copyright (c) 2008 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Admission control for the REST API
+
+Generating keys takes a lot longer than looking them up. Without limits, a
+burst of ``POST /new`` requests occupies all workers of the server, and key
+lookups queue up behind them. The ``AdmissionControl`` middleware gives key
+generation and key lookups separate lanes with their own concurrency limit
+and bounded queue, answers lookups of cached keys right away, and rejects
+requests with ``503 Service Unavailable`` when a lane is full.
+
+The lanes only help when a worker serves several requests at a time, for
+example gunicorn's ``gthread`` workers. Under servers handling one request
+per worker, every request is refused with an error.
+"""
+import logging
+import math
+import threading
+import time
+
+from webob import Request
+from webob import exc
+
+from keas.kmi import tracing
+from keas.kmi.facility import COMPACT_REQUEST_TYPE
+
+
+logger = logging.getLogger('kmi')
+
+
+class Lane:
+    """Admit at most ``concurrency`` requests at a time.
+
+    At most ``queueSize`` further requests wait for up to ``timeout``
+    seconds; all others are rejected.
+    """
+
+    alpha = 0.2
+
+    def __init__(self, name, concurrency, queueSize, timeout=5.0):
+        self.name = name
+        self.concurrency = concurrency
+        self.queueSize = queueSize
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        # Exponentially weighted moving average of the time in the lane
+        self.serviceTime = None
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """Return whether the request is admitted."""
+        with self._cond:
+            if self.active >= self.concurrency:
+                if self.waiting >= self.queueSize:
+                    self.rejected += 1
+                    return False
+                self.waiting += 1
+                try:
+                    deadline = time.monotonic() + self.timeout
+                    while self.active >= self.concurrency:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self.rejected += 1
+                            return False
+                        self._cond.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            self.active += 1
+            self.admitted += 1
+            return True
+
+    def release(self, elapsed):
+        with self._cond:
+            self.active -= 1
+            if self.serviceTime is None:
+                self.serviceTime = elapsed
+            else:
+                self.serviceTime += self.alpha * (elapsed - self.serviceTime)
+            self._cond.notify()
+
+    def retryAfter(self):
+        """Estimate the seconds until the queue has drained."""
+        with self._cond:
+            serviceTime = self.serviceTime or 1.0
+            backlog = self.active + self.waiting
+        return max(1, math.ceil(serviceTime * backlog / self.concurrency))
+
+    def __repr__(self):
+        return '<Lane {!r} {}/{} active, {}/{} waiting>'.format(
+            self.name, self.active, self.concurrency,
+            self.waiting, self.queueSize)
+
+
+class AdmissionControl:
+    """WSGI middleware scheduling the requests to a key management server."""
+
+    def __init__(self, app, context, keygen=None, key=None):
+        self.app = app
+        self.context = context
+        self.lanes = {
+            'keygen': keygen or Lane('keygen', 2, 16),
+            'key': key or Lane('key', 16, 64),
+        }
+        self._warned = False
+
+    def isCached(self, request):
+        if request.content_type == COMPACT_REQUEST_TYPE:
+            # Only cached keys are served with the compact protocol.
+            return True
+        return self.context.getCachedEncryptionKey(request.body) is not None
+
+    def classify(self, request):
+        """Return the name of the lane for the request, if any."""
+        if request.method != 'POST':
+            return None
+        if request.path_info == '/new':
+            return 'keygen'
+        if request.path_info == '/key' and not self.isCached(request):
+            return 'key'
+        return None
+
+    def __call__(self, environ, start_response):
+        if not environ.get('wsgi.multithread'):
+            # Nothing would ever be queued or shed, and lookups would wait
+            # behind key generations in the server's accept queue. Serving
+            # without the lanes is still better than failing.
+            if not self._warned:
+                self._warned = True
+                logger.warning(
+                    'Admission control needs a multi-threaded server, for '
+                    'example gunicorn with worker_class = gthread and '
+                    'threads; it is disabled')
+            return self.app(environ, start_response)
+        request = Request(environ)
+        name = self.classify(request)
+        if name is None:
+            return self.app(environ, start_response)
+        lane = self.lanes[name]
+        with tracing.phase('queue'):
+            admitted = lane.acquire()
+        if not admitted:
+            retryAfter = lane.retryAfter()
+            logger.warning('Rejected %s %s, retry after %ds',
+                           request.method, request.path_info, retryAfter)
+            response = exc.HTTPServiceUnavailable(
+                'Too many requests, try again later',
+                headers=[('Retry-After', str(retryAfter))])
+            return response(environ, start_response)
+        start = time.perf_counter()
+        try:
+            return self.app(environ, start_response)
+        finally:
+            lane.release(time.perf_counter() - start)
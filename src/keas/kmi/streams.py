@@ -0,0 +1,179 @@
+##############################################################################
+#
+# Copyright (c) 2008 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""File objects encrypting and decrypting on the fly
+
+The data is stored in the format of ``EncryptionService.encrypt_file()``:
+the size of the plain text as 8 byte little endian integer, the random
+initialization vector, and the data encrypted with AES in CBC mode, padded
+to the block size.
+
+In CBC mode, every block can be decrypted given only the block before it,
+so the decrypting reader supports seeking without decrypting everything in
+front of the new position.
+"""
+import io
+import struct
+
+
+BLOCK_SIZE = 16
+HEADER = struct.Struct('<Q')
+
+
+class EncryptingWriter(io.RawIOBase):
+    """Encrypt everything written to the underlying file ``fdst``.
+
+    The size of the data is written when the writer is closed, which closes
+    ``fdst`` as well.
+    """
+
+    def __init__(self, service, key, fdst):
+        self.raw = fdst
+        self.name = getattr(fdst, 'name', None)
+        self._start = fdst.tell()
+        iv = service.backend.randomBytes(BLOCK_SIZE)
+        self._encrypt = service.backend.cbcEncryptor(
+            service._getDerivedKey(key), iv)
+        fdst.write(HEADER.pack(0))
+        fdst.write(iv)
+        self._buffer = b''
+        self._size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self._size += len(data)
+        self._buffer += data
+        end = len(self._buffer) - len(self._buffer) % BLOCK_SIZE
+        if end:
+            self.raw.write(self._encrypt(self._buffer[:end]))
+            self._buffer = self._buffer[end:]
+        return len(data)
+
+    def tell(self):
+        return self._size
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._buffer:
+                # Pad like ``encrypt_file()``; the size tells where the data
+                # ends.
+                padding = BLOCK_SIZE - len(self._buffer)
+                self.raw.write(self._encrypt(self._buffer + b' ' * padding))
+                self._buffer = b''
+            end = self.raw.tell()
+            self.raw.seek(self._start)
+            self.raw.write(HEADER.pack(self._size))
+            self.raw.seek(end)
+        finally:
+            self.raw.close()
+            super().close()
+
+
+class DecryptingReader(io.RawIOBase):
+    """Decrypt the data of the underlying file ``fsrc`` while reading.
+
+    Closing the reader closes ``fsrc`` as well.
+    """
+
+    # The amount of data decrypted at once
+    chunkSize = 64 * 1024
+
+    def __init__(self, service, key, fsrc):
+        self.raw = fsrc
+        self.name = getattr(fsrc, 'name', None)
+        self._backend = service.backend
+        self._key = service._getDerivedKey(key)
+        header = fsrc.read(HEADER.size)
+        # An empty file holds no data, for example a new blob.
+        self.size = HEADER.unpack(header)[0] if header else 0
+        self._iv = fsrc.read(BLOCK_SIZE)
+        self._dataStart = fsrc.tell()
+        self._pos = 0
+        # Decrypted data starting at the block ``_plainStart``
+        self._plain = b''
+        self._plainStart = 0
+        # The position of the next block the decryptor expects
+        self._decrypt = None
+        self._next = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError('invalid whence (%r)' % whence)
+        if pos < 0:
+            raise ValueError('negative seek position %d' % pos)
+        self._pos = pos
+        return pos
+
+    def _fill(self, size):
+        start = self._pos - self._pos % BLOCK_SIZE
+        if start != self._next:
+            # Start decrypting at a new position; the block before it is the
+            # initialization vector.
+            if start == 0:
+                iv = self._iv
+            else:
+                self.raw.seek(self._dataStart + start - BLOCK_SIZE)
+                iv = self.raw.read(BLOCK_SIZE)
+            self.raw.seek(self._dataStart + start)
+            self._decrypt = self._backend.cbcDecryptor(self._key, iv)
+        size = max(size, self.chunkSize)
+        size += -size % BLOCK_SIZE
+        data = self.raw.read(size)
+        data = data[:len(data) - len(data) % BLOCK_SIZE]
+        self._plain = self._decrypt(data)
+        self._plainStart = start
+        self._next = start + len(data)
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.size - self._pos)
+        if size <= 0:
+            return 0
+        offset = self._pos - self._plainStart
+        if not (0 <= offset < len(self._plain)):
+            self._fill(size)
+            offset = self._pos - self._plainStart
+        data = self._plain[offset:offset + size]
+        if not data:
+            # The file is shorter than its header says.
+            return 0
+        buffer[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.raw.close()
+        finally:
+            super().close()
@@ -16,8 +16,14 @@
 
 import optparse
 import os
+import shutil
+import struct
 import sys
+import tempfile
 import textwrap
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 
 from keas.kmi.facility import LocalKeyManagementFacility
@@ -51,7 +57,7 @@ def read_kek(kekfile):
 
 def read_data(filename=None):
     if not filename:
-        return sys.stdin.read()
+        return sys.stdin.buffer.read()
     else:
         try:
             with open(filename, 'rb') as fp:
@@ -82,6 +88,190 @@ def decrypt(kmf, kekfile, filename=None):
     os.write(sys.stdout.fileno(), decrypted)
 
 
+class BulkCrypt:
+    """Encrypt or decrypt many files with a single key lookup.
+
+    The files are written in the format of ``encrypt_file()``. Reading,
+    de- or encryption and writing of the individual files are spread over a
+    pool of worker threads.
+    """
+
+    chunksize = 64 * 1024
+
+    def __init__(self, service, key, decrypting=False, workers=4):
+        self.service = service
+        self.decrypting = decrypting
+        self.workers = workers
+        self.files = 0
+        self.bytesRead = 0
+        self.bytesWritten = 0
+        self.failed = []
+        self.elapsed = 0.0
+        self._encryptionKey = service._getDerivedKey(key)
+        self._lock = threading.Lock()
+
+    def _count(self, read, written):
+        with self._lock:
+            self.files += 1
+            self.bytesRead += read
+            self.bytesWritten += written
+
+    def process(self, fsrc, fdst):
+        """Encrypt or decrypt a file."""
+        if self.decrypting:
+            self.service._decryptFile(
+                self._encryptionKey, fsrc, fdst, self.chunksize)
+        else:
+            self.service._encryptFile(
+                self._encryptionKey, fsrc, fdst, self.chunksize)
+
+    def processPath(self, src, dst):
+        directory = os.path.dirname(dst)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp = dst + '.tmp'
+        try:
+            with open(src, 'rb') as fsrc, open(tmp, 'wb') as fdst:
+                self.process(fsrc, fdst)
+                read, written = fsrc.tell(), fdst.tell()
+            os.replace(tmp, dst)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self._count(read, written)
+
+    def _processPath(self, src, dst):
+        try:
+            self.processPath(src, dst)
+        except (OSError, ValueError) as e:
+            print('Could not process %s: %s' % (src, e), file=sys.stderr)
+            with self._lock:
+                self.failed.append(src)
+
+    def run(self, jobs):
+        """Process the ``(source, destination)`` paths of ``jobs``."""
+        start = time.perf_counter()
+        with ThreadPoolExecutor(self.workers) as pool:
+            for _ in pool.map(lambda job: self._processPath(*job), jobs):
+                pass
+        self.elapsed += time.perf_counter() - start
+
+    def stream(self, fsrc, fdst):
+        """Process a stream, such as stdin, into another one.
+
+        Neither stream needs to be seekable.
+        """
+        start = time.perf_counter()
+        if self.decrypting:
+            read, written = self._decryptStream(fsrc, fdst)
+        else:
+            read, written = self._encryptStream(fsrc, fdst)
+        self._count(read, written)
+        self.elapsed += time.perf_counter() - start
+
+    def _encryptStream(self, fsrc, fdst):
+        # The size of the data is written in front of it, so the encrypted
+        # data is spooled until the size is known.
+        with tempfile.SpooledTemporaryFile(10 * 2**20) as spool:
+            self.process(fsrc, spool)
+            written = spool.tell()
+            spool.seek(0)
+            header = spool.read(struct.calcsize('<Q'))
+            fdst.write(header)
+            shutil.copyfileobj(spool, fdst, self.chunksize)
+        return struct.unpack('<Q', header)[0], written
+
+    def _decryptStream(self, fsrc, fdst):
+        header = fsrc.read(struct.calcsize('<Q'))
+        size = struct.unpack('<Q', header)[0]
+        iv = fsrc.read(16)
+        decrypt = self.service.backend.cbcDecryptor(self._encryptionKey, iv)
+        read = len(header) + len(iv)
+        remaining = size
+        while remaining > 0:
+            chunk = fsrc.read(self.chunksize)
+            if not chunk:
+                break
+            read += len(chunk)
+            data = decrypt(chunk)[:remaining]
+            fdst.write(data)
+            remaining -= len(data)
+        return read, size - remaining
+
+    def statistics(self):
+        elapsed = self.elapsed or 1e-9
+        return ('%d files, %.1f MB read, %.1f MB written in %.2f s: '
+                '%.1f files/s, %.1f MB/s' % (
+                    self.files, self.bytesRead / 2**20,
+                    self.bytesWritten / 2**20, self.elapsed,
+                    self.files / elapsed, self.bytesRead / 2**20 / elapsed))
+
+
+def find_files(paths, files_from=None):
+    """Return the files to process with their paths relative to the output.
+
+    Directories are searched recursively, and their files keep the name of
+    the directory in front of their path, like ``cp -r`` does.
+
+    :raises ValueError: if two files would be written to the same path.
+    """
+    paths = list(paths)
+    if files_from:
+        if files_from == '-':
+            lines = sys.stdin.read().splitlines()
+        else:
+            with open(files_from) as file:
+                lines = file.read().splitlines()
+        paths.extend(line for line in lines if line.strip())
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            parent = os.path.dirname(os.path.abspath(path))
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    src = os.path.join(dirpath, filename)
+                    found.append(
+                        (src, os.path.relpath(os.path.abspath(src), parent)))
+            continue
+        relative = os.path.normpath(path)
+        if os.path.isabs(relative) or relative.startswith(os.pardir):
+            relative = os.path.basename(relative)
+        found.append((path, relative))
+    sources = {}
+    for src, relative in found:
+        if relative in sources:
+            raise ValueError('{} and {} would both be written to {}'.format(
+                sources[relative], src, relative))
+        sources[relative] = src
+    return found
+
+
+def bulk(kmf, kekfile, *paths, decrypting=False, output_dir=None,
+         files_from=None, workers=4):
+    crypt = BulkCrypt(kmf, read_kek(kekfile), decrypting, workers)
+    if paths == ('-',) and not files_from:
+        crypt.stream(sys.stdin.buffer, sys.stdout.buffer)
+        sys.stdout.buffer.flush()
+    else:
+        if not paths and not files_from:
+            raise TypeError('no files given')
+        if not output_dir:
+            print('Please specify the output directory', file=sys.stderr)
+            sys.exit(1)
+        try:
+            found = find_files(paths, files_from)
+        except ValueError as error:
+            print(error, file=sys.stderr)
+            sys.exit(1)
+        crypt.run([(src, os.path.join(output_dir, relative))
+                   for src, relative in found])
+    print(crypt.statistics(), file=sys.stderr)
+    if crypt.failed:
+        sys.exit(1)
+
+
 parser = optparse.OptionParser(textwrap.dedent("""\
      %prog URL
 
@@ -98,6 +288,13 @@ parser = optparse.OptionParser(textwrap.dedent("""\
 
            %prog URL -g key.txt > secretkey.bin
                 get the secret encryption key
+
+           %prog URL -e key.txt -b -o OUTDIR FILE|DIR...
+                encrypt many files with encrypt_file, the same with -d
+                to decrypt them
+
+           %prog URL -e key.txt -b - < data.bin > encrypted.bin
+                encrypt stdin with encrypt_file
     """.rstrip()),
     description="Client for a Key Management Server.")
 parser.add_option(
@@ -120,6 +317,19 @@ parser.add_option(
     help='decrypt data',
     action='store_const', dest='action',
     const=decrypt)
+parser.add_option(
+    '-b', '--bulk', action='store_true', default=False,
+    help='encrypt or decrypt files, directories or stdin in the format '
+         'of encrypt_file')
+parser.add_option(
+    '-o', '--output-dir',
+    help='directory for the files written in bulk mode')
+parser.add_option(
+    '-f', '--files-from',
+    help='file listing the files to process in bulk mode, - for stdin')
+parser.add_option(
+    '-j', '--workers', type='int', default=4,
+    help='number of worker threads in bulk mode (default: %default)')
 
 
 def main(argv=None):
@@ -135,6 +345,13 @@ def main(argv=None):
     kmf = LocalKeyManagementFacility(url)
 
     try:
-        opts.action(kmf, *args)
+        if opts.bulk:
+            if opts.action not in (encrypt, decrypt):
+                parser.error('Bulk mode needs --encrypt or --decrypt')
+            bulk(kmf, *args, decrypting=opts.action is decrypt,
+                 output_dir=opts.output_dir, files_from=opts.files_from,
+                 workers=opts.workers)
+        else:
+            opts.action(kmf, *args)
     except TypeError:
         parser.error('incorrect number of arguments')
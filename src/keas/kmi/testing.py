@@ -43,9 +43,10 @@ EncryptedEncryptionKey = (
 
 class FakeHTTPMessage:
 
-    def __init__(self, res):
+    def __init__(self, res, headers=()):
         self.res = res
-        self.headers = ['Server: Fake/1.0']
+        self.headers = ['Server: Fake/1.0'] + [
+            '%s: %s' % header for header in headers]
 
 
 class FakeHTTPResponse:
@@ -54,10 +55,15 @@ class FakeHTTPResponse:
     status = 200
     reason = 'Ok'
 
-    def __init__(self, data):
+    def __init__(self, data, status=None, reason=None, headers=()):
         self.fp = BytesIO(data)
         self.fp_len = len(data)
-        self.msg = FakeHTTPMessage(self)
+        self.msg = FakeHTTPMessage(self, headers)
+        if status is not None:
+            self.status = status
+        if reason is not None:
+            self.reason = reason
+        self._headers = list(headers)
 
     def read(self, amt=10 * 2**10):
         data = self.fp.read(amt)
@@ -65,6 +71,15 @@ class FakeHTTPResponse:
             self.fp = None
         return data
 
+    def getheader(self, name, default=None):
+        for key, value in self._headers:
+            if key.lower() == name.lower():
+                return value
+        return default
+
+    def getheaders(self):
+        return self._headers
+
     def close(self):
         pass
 
@@ -79,6 +94,9 @@ class FakeHTTPConnection:
     def request(self, method, url, body=None, headers=None):
         self.request_data = (method, url, body, headers)
 
+    def close(self):
+        pass
+
     def getresponse(self, buffering=False):
         url = self.request_data[1]
         if url == '/new':
@@ -88,8 +106,13 @@ class FakeHTTPConnection:
 
         io = BytesIO(self.request_data[2])
         req = webob.Request({'wsgi.input': io})
+        for name, value in (self.request_data[3] or {}).items():
+            req.headers[name] = value
+        req.content_length = len(self.request_data[2])
         res = view(self.context, req)
-        return FakeHTTPResponse(res.body)
+        return FakeHTTPResponse(
+            res.body, res.status_int, res.status.split(' ', 1)[1],
+            res.headerlist)
 
 
 def setupRestApi(localFacility, masterFacility):
@@ -21,6 +21,7 @@ import transaction
 from zope.app.testing import setup
 from zope.component import provideUtility
 
+from keas.kmi.backends import availableBackends
 from keas.kmi.interfaces import IKeyManagementFacility
 from keas.kmi.testing import TestingKeyManagementFacility
 
@@ -39,15 +40,62 @@ def tearDownPersistent(test):
 
 
 def test_suite():
-    return unittest.TestSuite([
+    suite = unittest.TestSuite([
         doctest.DocFileSuite(
             'README.txt',
             optionflags=doctest.NORMALIZE_WHITESPACE | doctest.ELLIPSIS),
         doctest.DocFileSuite(
             'facility.txt',
             optionflags=doctest.NORMALIZE_WHITESPACE | doctest.ELLIPSIS),
+        doctest.DocFileSuite(
+            'rotation.txt',
+            optionflags=doctest.NORMALIZE_WHITESPACE | doctest.ELLIPSIS),
+        doctest.DocFileSuite(
+            'cache.txt',
+            optionflags=doctest.NORMALIZE_WHITESPACE | doctest.ELLIPSIS),
+        doctest.DocFileSuite(
+            'wsgi.txt',
+            optionflags=doctest.NORMALIZE_WHITESPACE | doctest.ELLIPSIS),
+        doctest.DocFileSuite(
+            'asgi.txt',
+            optionflags=doctest.NORMALIZE_WHITESPACE | doctest.ELLIPSIS),
+        doctest.DocFileSuite(
+            'replication.txt',
+            optionflags=doctest.NORMALIZE_WHITESPACE | doctest.ELLIPSIS),
+        doctest.DocFileSuite(
+            'endpoints.txt',
+            optionflags=doctest.NORMALIZE_WHITESPACE | doctest.ELLIPSIS),
+        doctest.DocFileSuite(
+            'proxy.txt',
+            optionflags=doctest.NORMALIZE_WHITESPACE | doctest.ELLIPSIS),
+        doctest.DocFileSuite(
+            'durability.txt',
+            optionflags=doctest.NORMALIZE_WHITESPACE | doctest.ELLIPSIS),
+        doctest.DocFileSuite(
+            'scheduling.txt',
+            optionflags=doctest.NORMALIZE_WHITESPACE | doctest.ELLIPSIS),
+        doctest.DocFileSuite(
+            'tracing.txt',
+            optionflags=doctest.NORMALIZE_WHITESPACE | doctest.ELLIPSIS),
+        doctest.DocFileSuite(
+            'testclient.txt',
+            optionflags=doctest.NORMALIZE_WHITESPACE | doctest.ELLIPSIS),
+        doctest.DocFileSuite(
+            'loadtest.txt',
+            optionflags=doctest.NORMALIZE_WHITESPACE | doctest.ELLIPSIS),
+        doctest.DocFileSuite(
+            'blob.txt',
+            setUp=setUpPersistent, tearDown=tearDownPersistent,
+            optionflags=doctest.NORMALIZE_WHITESPACE | doctest.ELLIPSIS),
         doctest.DocFileSuite(
             'persistent.txt',
             setUp=setUpPersistent, tearDown=tearDownPersistent,
             optionflags=doctest.NORMALIZE_WHITESPACE | doctest.ELLIPSIS),
     ])
+    # The compatibility of the backends can only be tested if the optional
+    # ones are installed.
+    if len(availableBackends()) > 1:
+        suite.addTest(doctest.DocFileSuite(
+            'backends.txt',
+            optionflags=doctest.NORMALIZE_WHITESPACE | doctest.ELLIPSIS))
+    return suite
@@ -0,0 +1,240 @@
+##############################################################################
+#
+# Copyright (c) 2008 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Timing of the phases of requests
+
+The facilities mark the expensive steps of their operations as phases,
+for example reading a key file or importing an RSA key. While a trace is
+active, typically for the duration of a request, the time spent in every
+phase is recorded in it. When the trace ends, it is passed to the hooks
+registered with ``addHook()``, like ``SlowRequestLog``. Outside of traces,
+phases cost next to nothing.
+
+Traces never contain key material; at most the hash naming a key.
+"""
+import collections
+import contextlib
+import contextvars
+import logging
+import sys
+import threading
+import time
+
+
+logger = logging.getLogger('kmi')
+
+_current = contextvars.ContextVar('keas.kmi.tracing', default=None)
+_hooks = []
+# Thread ident -> trace of the request the thread is serving
+_active = {}
+
+_NULL = contextlib.nullcontext()
+
+
+class Trace:
+    """The phases of a request or operation."""
+
+    def __init__(self, name, **info):
+        self.name = name
+        self.info = info
+        self.phases = []
+        self.thread = threading.get_ident()
+        self.start = time.perf_counter()
+        self.duration = None
+
+    def annotate(self, **info):
+        self.info.update(info)
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def breakdown(self):
+        """Return the time spent in the phases, in milliseconds, as text."""
+        return ' '.join('%s=%.1fms' % (name, seconds * 1000)
+                        for name, seconds in self.phases)
+
+    def asDict(self):
+        result = dict(self.info)
+        result.update(
+            name=self.name,
+            duration=self.duration,
+            phases=[{'name': name, 'duration': seconds}
+                    for name, seconds in self.phases])
+        return result
+
+    def __repr__(self):
+        return '<Trace %r %s>' % (self.name, self.breakdown())
+
+
+class _Phase:
+
+    __slots__ = ('trace', 'name', 'start')
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.trace.phases.append(
+            (self.name, time.perf_counter() - self.start))
+
+
+def current():
+    """Return the active trace, if any."""
+    return _current.get()
+
+
+def phase(name):
+    """Return a context manager recording its duration in the trace."""
+    trace = _current.get()
+    if trace is None:
+        return _NULL
+    return _Phase(trace, name)
+
+
+def annotate(**info):
+    """Add information, like the hash of a key, to the active trace."""
+    trace = _current.get()
+    if trace is not None:
+        trace.info.update(info)
+
+
+@contextlib.contextmanager
+def trace(name, **info):
+    """Trace the phases of the code in the ``with`` block."""
+    active = Trace(name, **info)
+    token = _current.set(active)
+    previous = _active.get(active.thread)
+    _active[active.thread] = active
+    try:
+        yield active
+    finally:
+        active.duration = time.perf_counter() - active.start
+        _current.reset(token)
+        if previous is None:
+            _active.pop(active.thread, None)
+        else:
+            _active[active.thread] = previous
+        for hook in list(_hooks):
+            try:
+                hook(active)
+            except Exception:
+                logger.exception('Error in trace hook %r', hook)
+
+
+def addHook(hook):
+    """Call ``hook`` with every trace that ended."""
+    _hooks.append(hook)
+
+
+def removeHook(hook):
+    _hooks.remove(hook)
+
+
+class SlowRequestLog:
+    """A trace hook logging the traces taking ``threshold`` seconds or more.
+
+    The log record carries the trace as ``kmi_trace`` dictionary for
+    structured logging.
+    """
+
+    def __init__(self, threshold=1.0, logger=logger):
+        self.threshold = threshold
+        self.logger = logger
+
+    def __call__(self, trace):
+        if trace.duration < self.threshold:
+            return
+        info = ' '.join('%s=%s' % item for item in sorted(trace.info.items()))
+        self.logger.warning(
+            'Slow request %s took %.1fms (%s): %s',
+            trace.name, trace.duration * 1000, info, trace.breakdown(),
+            extra={'kmi_trace': trace.asDict()})
+
+
+class SamplingProfiler:
+    """Sample the stacks of the threads serving traced requests.
+
+    Only requests whose trace name is in ``routes`` are sampled, or all of
+    them if no routes are given. Every ``reportInterval`` seconds, the most
+    frequent stacks are logged in the collapsed format of flame graph tools.
+    """
+
+    def __init__(self, routes=None, interval=0.01, reportInterval=60.0,
+                 limit=20, logger=logger):
+        self.routes = set(routes) if routes else None
+        self.interval = interval
+        self.reportInterval = reportInterval
+        self.limit = limit
+        self.logger = logger
+        self.samples = collections.Counter()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def sample(self):
+        frames = sys._current_frames()
+        for ident, trace in list(_active.items()):
+            if self.routes is not None and trace.name not in self.routes:
+                continue
+            frame = frames.get(ident)
+            stack = []
+            while frame is not None:
+                stack.append('%s:%s' % (
+                    frame.f_globals.get('__name__', '?'),
+                    frame.f_code.co_name))
+                frame = frame.f_back
+            stack.append(trace.name)
+            self.samples[';'.join(reversed(stack))] += 1
+
+    def report(self):
+        """Return the most frequent stacks and reset the samples."""
+        samples, self.samples = self.samples, collections.Counter()
+        return '\n'.join('%s %d' % item
+                         for item in samples.most_common(self.limit))
+
+    def _run(self):
+        nextReport = time.monotonic() + self.reportInterval
+        while not self._stopped.wait(self.interval):
+            self.sample()
+            if time.monotonic() >= nextReport:
+                nextReport += self.reportInterval
+                if self.samples:
+                    self.logger.info('Profile:\n%s', self.report())
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run, name='kmi-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+class TracingMiddleware:
+    """WSGI middleware tracing every request, named by its path."""
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        with trace(environ.get('PATH_INFO') or '/',
+                   method=environ.get('REQUEST_METHOD')):
+            return self.app(environ, start_response)
@@ -13,29 +13,178 @@
 ##############################################################################
 """WSGI application for the Key Management Server.
 """
+import logging
 import os
+import threading
 
-import pyramid.config
+from webob import Request
+from webob import exc
 
 import keas.kmi
 from keas.kmi import facility
+from keas.kmi import rest
 
 
+logger = logging.getLogger('kmi')
+
 FACILITY = None
 
+# (request method, path) -> view, mirroring the routes in configure.zcml
+ROUTES = {
+    ('GET', '/'): rest.get_status,
+    ('GET', '/changes'): rest.get_changes,
+    ('POST', '/new'): rest.create_key,
+    ('POST', '/key'): rest.get_key,
+}
+
 
 def get_facility(environ):
     return FACILITY
 
 
-def application_factory(global_config, **kw):
+def asbool(value):
+    return str(value).strip().lower() in ('true', 'yes', 'on', '1')
+
+
+def create_facility(kw):
     storage_dir = os.path.abspath(kw['storage-dir'])
     if not os.path.exists(storage_dir):
         os.mkdir(storage_dir)
     global FACILITY
-    FACILITY = facility.KeyManagementFacility(storage_dir)
+    if kw.get('primary-url'):
+        # A read replica of another server.
+        from keas.kmi.replication import ReplicaKeyManagementFacility
+        FACILITY = ReplicaKeyManagementFacility(storage_dir, kw['primary-url'])
+        FACILITY.start(float(kw.get('replication-interval', 1.0)))
+    else:
+        FACILITY = facility.KeyManagementFacility(storage_dir)
+    if kw.get('key-scheme'):
+        FACILITY.keyScheme = kw['key-scheme']
+    if kw.get('durability'):
+        FACILITY.durability = kw['durability']
+    if kw.get('crypto-backend'):
+        FACILITY.cryptoBackend = kw['crypto-backend']
+    if asbool(kw.get('changelog', 'false')):
+        from keas.kmi.replication import ChangeLog
+        FACILITY.changelog = ChangeLog(storage_dir)
+    return FACILITY
+
+
+def admission_control(app, kmf, kw):
+    """Wrap the application in ``AdmissionControl`` if it is enabled."""
+    if not asbool(kw.get('admission-control', 'false')):
+        return app
+    from keas.kmi.scheduling import AdmissionControl
+    from keas.kmi.scheduling import Lane
+    timeout = float(kw.get('queue-timeout', 5.0))
+    return AdmissionControl(
+        app, kmf,
+        keygen=Lane('keygen',
+                    int(kw.get('keygen-concurrency', 2)),
+                    int(kw.get('keygen-queue', 16)), timeout),
+        key=Lane('key',
+                 int(kw.get('key-concurrency', 16)),
+                 int(kw.get('key-queue', 64)), timeout))
+
+
+def request_tracing(app, kw):
+    """Trace the phases of the requests if it is enabled.
+
+    ``slow-request-threshold`` logs the requests taking that many seconds
+    or longer, and ``profile-routes`` samples the stacks of the requests to
+    the given paths.
+    """
+    threshold = kw.get('slow-request-threshold')
+    routes = kw.get('profile-routes', '').split()
+    if not (asbool(kw.get('tracing', 'false')) or threshold or routes):
+        return app
+    from keas.kmi import tracing
+    if threshold:
+        tracing.addHook(tracing.SlowRequestLog(float(threshold)))
+    if routes:
+        profiler = tracing.SamplingProfiler(
+            [] if routes == ['*'] else routes,
+            interval=float(kw.get('profile-interval', 0.01)),
+            reportInterval=float(kw.get('profile-report-interval', 60)))
+        profiler.start()
+    return tracing.TracingMiddleware(app)
+
+
+def application_factory(global_config, **kw):
+    import pyramid.config
+    kmf = create_facility(kw)
     config = pyramid.config.Configurator(
         root_factory=get_facility, package=keas.kmi)
     config.include('pyramid_zcml')
     config.load_zcml('configure.zcml')
-    return config.make_wsgi_app()
+    return request_tracing(
+        admission_control(config.make_wsgi_app(), kmf, kw), kw)
+
+
+class Application:
+    """A minimal WSGI application dispatching directly to the REST views.
+
+    It does not need pyramid or the ZCML machinery, which makes it start a
+    lot faster than the application created by ``application_factory``.
+    """
+
+    def __init__(self, context, routes=ROUTES):
+        self.context = context
+        self.routes = routes
+
+    def __call__(self, environ, start_response):
+        request = Request(environ)
+        view = self.routes.get((request.method, request.path_info))
+        if view is not None:
+            response = view(self.context, request)
+        elif any(path == request.path_info for method, path in self.routes):
+            response = exc.HTTPMethodNotAllowed()
+        else:
+            response = exc.HTTPNotFound()
+        return response(environ, start_response)
+
+
+def warm(kmf):
+    count = kmf.warm()
+    logger.info('Found %d keys', count)
+
+
+def lean_application_factory(global_config, **kw):
+    kmf = create_facility(kw)
+    if asbool(kw.get('warm', 'true')):
+        thread = threading.Thread(
+            target=warm, args=(kmf,), name='kmi-warm', daemon=True)
+        thread.start()
+    return request_tracing(admission_control(Application(kmf), kmf, kw), kw)
+
+
+def asgi_application_factory(global_config, **kw):
+    if kw.get('primary-url'):
+        # The worker processes only get the storage directory, and a replica
+        # has to forward key generation to its primary.
+        raise ValueError(
+            'The ASGI application cannot serve a read replica (primary-url)')
+    kmf = create_facility(kw)
+    processes = int(kw['processes']) if kw.get('processes') else None
+    from keas.kmi.asgi import ASGIApplication
+    return ASGIApplication(kmf, processes=processes)
+
+
+def proxy_application_factory(global_config, **kw):
+    """Serve the REST API from a caching proxy of the master servers.
+
+    ``master-url`` lists the URLs of the master and its replicas.
+    """
+    from keas.kmi.proxy import ProxyKeyManagementFacility
+    global FACILITY
+    FACILITY = ProxyKeyManagementFacility(kw['master-url'].split())
+    if kw.get('cache-size'):
+        FACILITY.cacheSize = int(kw['cache-size'])
+    if kw.get('cache-timeout'):
+        FACILITY.timeout = int(kw['cache-timeout'])
+    if kw.get('pool-size'):
+        FACILITY.poolSize = int(kw['pool-size'])
+    if kw.get('crypto-backend'):
+        FACILITY.cryptoBackend = kw['crypto-backend']
+    return request_tracing(
+        admission_control(Application(FACILITY), FACILITY, kw), kw)